@@ -0,0 +1,156 @@
+"""housing version
+
+Revision ID: 2a4e8f47b611
+Revises: 9d2e7b14c6a8
+Create Date: 2026-10-18 15:22:49.731204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "2a4e8f47b611"
+down_revision = "9d2e7b14c6a8"
+branch_labels = None
+depends_on = None
+
+# table -> column with the id of the housing whose document the row is part of
+DOCUMENT_SOURCES = {
+    "housing": "id",
+    "housing_image": "housing_id",
+    "housing_calendar": "housing_id",
+    "housing_pricing": "housing_id",
+    "characteristic": "housing_id",
+    "housing_rule": "housing_id",
+    "housing_comfort": "housing_id",
+    "housing_rating": "housing_id",
+    "housing_review_rating": "housing_id",
+}
+# rows shared by the documents of many housings
+DOCUMENT_REFERENCES = (
+    '"user"',
+    "housing_type",
+    "characteristic_type",
+    "rule",
+    "comfort",
+)
+
+
+def upgrade():
+    op.create_table(
+        "housing_version",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column(
+            "created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column(
+            "updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column("housing_id", sa.Integer(), nullable=False),
+        sa.Column("version", sa.BigInteger(), server_default="1", nullable=False),
+        sa.ForeignKeyConstraint(
+            ["housing_id"],
+            ["housing.id"],
+            name="fk_on_housing",
+            onupdate="CASCADE",
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("housing_id"),
+    )
+    op.execute("insert into housing_version (housing_id) select id from housing")
+
+    # the row is created with the housing and removed by its cascade; changes
+    # only update it, so the rows deleted by the cascade don't recreate it
+    op.execute(
+        """
+        create function bump_housing_versions(housing_ids integer[])
+        returns void language plpgsql as $$
+        begin
+            update housing_version
+            set version = version + 1, updated_at = now()
+            where housing_id = any(housing_ids);
+        end
+        $$
+        """
+    )
+    # tg_argv[0] is the column with the id of the housing
+    op.execute(
+        """
+        create function housing_version_source() returns trigger language plpgsql as $$
+        declare
+            old_id integer := to_jsonb(old) ->> tg_argv[0];
+            new_id integer := to_jsonb(new) ->> tg_argv[0];
+        begin
+            if tg_table_name = 'housing' and tg_op = 'INSERT' then
+                insert into housing_version (housing_id) values (new_id);
+            else
+                perform bump_housing_versions(array[old_id, new_id]);
+            end if;
+            return null;
+        end
+        $$
+        """
+    )
+    for table, column in DOCUMENT_SOURCES.items():
+        op.execute(
+            f"""
+            create trigger housing_version_source
+            after insert or update or delete on {table}
+            for each row execute function housing_version_source('{column}')
+            """
+        )
+
+    # deleting one of them cascades to the rows of the documents, or fails
+    op.execute(
+        """
+        create function housing_version_reference() returns trigger
+        language plpgsql as $$
+        begin
+            if tg_table_name = 'user' then
+                perform bump_housing_versions(array(
+                    select id from housing where user_id = new.id
+                ));
+            elsif tg_table_name = 'housing_type' then
+                perform bump_housing_versions(array(
+                    select id from housing where type_id = new.id
+                ));
+            elsif tg_table_name = 'characteristic_type' then
+                perform bump_housing_versions(array(
+                    select housing_id from characteristic
+                    where characteristic_type_id = new.id
+                ));
+            elsif tg_table_name = 'rule' then
+                perform bump_housing_versions(array(
+                    select housing_id from housing_rule where rule_id = new.id
+                ));
+            else
+                perform bump_housing_versions(array(
+                    select housing_id from housing_comfort where comfort_id = new.id
+                ));
+            end if;
+            return null;
+        end
+        $$
+        """
+    )
+    for table in DOCUMENT_REFERENCES:
+        op.execute(
+            f"""
+            create trigger housing_version_reference after update on {table}
+            for each row when (old.* is distinct from new.*)
+            execute function housing_version_reference()
+            """
+        )
+
+
+def downgrade():
+    for table in DOCUMENT_REFERENCES:
+        op.execute(f"drop trigger housing_version_reference on {table}")
+    op.execute("drop function housing_version_reference()")
+    for table in DOCUMENT_SOURCES:
+        op.execute(f"drop trigger housing_version_source on {table}")
+    op.execute("drop function housing_version_source()")
+    op.execute("drop function bump_housing_versions(integer[])")
+
+    op.drop_table("housing_version")
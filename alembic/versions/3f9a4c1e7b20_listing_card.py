@@ -0,0 +1,231 @@
+"""listing card
+
+Revision ID: 3f9a4c1e7b20
+Revises: 51e8eb30b427
+Create Date: 2026-10-18 10:03:18.550142
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "3f9a4c1e7b20"
+down_revision = "51e8eb30b427"
+branch_labels = None
+depends_on = None
+
+CARD_COLUMNS = """id, created_at, updated_at, name, address, category_id,
+    category_name, type_id, type_name, main_image, per_night, guests, bedrooms,
+    beds, baths, rating, rating_count"""
+# what the card shows, the columns after id, created_at and updated_at
+CARD_FIELDS = [column.strip() for column in CARD_COLUMNS.split(",")][3:]
+CARD_CURRENT = ", ".join(f"listing_card.{field}" for field in CARD_FIELDS)
+CARD_EXCLUDED = ", ".join(f"excluded.{field}" for field in CARD_FIELDS)
+CARD_SELECT = """
+    select h.id, h.created_at, {updated_at}, h.name, h.address, h.category_id,
+        c.name, h.type_id, t.name, i.file_name, p.per_night, ch.guests,
+        ch.bedrooms, ch.beds, ch.baths, coalesce(r.rating, 0),
+        coalesce(r.grade_count, 0)
+    from housing h
+    join housing_image i on i.housing_id = h.id and i.is_main
+    join housing_category c on c.id = h.category_id
+    join housing_type t on t.id = h.type_id
+    left join housing_pricing p on p.housing_id = h.id
+    left join housing_rating r on r.housing_id = h.id
+    cross join lateral (
+        select max(amount) filter (where ct.name = 'guests') guests,
+            max(amount) filter (where ct.name = 'bedrooms') bedrooms,
+            max(amount) filter (where ct.name = 'beds') beds,
+            max(amount) filter (where ct.name = 'baths') baths
+        from characteristic
+        join characteristic_type ct on ct.id = characteristic_type_id
+        where characteristic.housing_id = h.id
+    ) ch
+"""
+# table -> column with the id of the housing whose card the row is part of
+CARD_SOURCES = {
+    "housing": "id",
+    "housing_image": "housing_id",
+    "housing_pricing": "housing_id",
+    "housing_rating": "housing_id",
+    "characteristic": "housing_id",
+}
+# indexes which served /offers, /offers/export and the wishlist before they
+# read listing_card
+HOUSING_OFFERS_INDEXES = (
+    ("ix_housing_created_at_id", "housing", ["created_at", "id"]),
+    (
+        "ix_housing_category_id_created_at_id",
+        "housing",
+        ["category_id", "created_at", "id"],
+    ),
+    ("ix_housing_type_id_created_at_id", "housing", ["type_id", "created_at", "id"]),
+    ("ix_housing_updated_at_id", "housing", ["updated_at", "id"]),
+    (
+        "ix_housing_pricing_per_night_housing_id",
+        "housing_pricing",
+        ["per_night", "housing_id"],
+    ),
+    ("ix_housing_rating_rating_housing_id", "housing_rating", ["rating", "housing_id"]),
+)
+
+
+def upgrade():
+    op.create_table(
+        "listing_card",
+        sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column(
+            "created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column(
+            "updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column("name", sa.String(length=50), nullable=False),
+        sa.Column("address", sa.String(), nullable=False),
+        sa.Column("category_id", sa.Integer(), nullable=False),
+        sa.Column("category_name", sa.String(length=50), nullable=False),
+        sa.Column("type_id", sa.Integer(), nullable=False),
+        sa.Column("type_name", sa.String(length=50), nullable=False),
+        sa.Column("main_image", sa.String(), nullable=True),
+        sa.Column("per_night", sa.Integer(), nullable=True),
+        sa.Column("guests", sa.Integer(), nullable=True),
+        sa.Column("bedrooms", sa.Integer(), nullable=True),
+        sa.Column("beds", sa.Integer(), nullable=True),
+        sa.Column("baths", sa.Integer(), nullable=True),
+        sa.Column("rating", sa.Float(), server_default="0", nullable=False),
+        sa.Column("rating_count", sa.Integer(), server_default="0", nullable=False),
+        sa.ForeignKeyConstraint(
+            ["id"],
+            ["housing.id"],
+            name="fk_on_housing",
+            onupdate="CASCADE",
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    for name, columns in (
+        ("ix_listing_card_created_at_id", ["created_at", "id"]),
+        ("ix_listing_card_per_night_id", ["per_night", "id"]),
+        ("ix_listing_card_rating_id", ["rating", "id"]),
+        (
+            "ix_listing_card_category_id_created_at_id",
+            ["category_id", "created_at", "id"],
+        ),
+        ("ix_listing_card_type_id_created_at_id", ["type_id", "created_at", "id"]),
+        ("ix_listing_card_updated_at_id", ["updated_at", "id"]),
+    ):
+        op.create_index(name, "listing_card", columns, unique=False)
+    op.create_index(
+        "ix_liked_housing_user_id_housing_id",
+        "liked_housing",
+        ["user_id", "housing_id"],
+        unique=False,
+    )
+    for name, table, _ in HOUSING_OFFERS_INDEXES:
+        op.drop_index(name, table_name=table)
+
+    op.execute(
+        f"""
+        insert into listing_card ({CARD_COLUMNS})
+        {CARD_SELECT.format(updated_at="h.updated_at")}
+        """
+    )
+
+    # the housing row is locked first, so that concurrent changes to the parts
+    # of one card are applied one after the other, each reading the committed
+    # result of the previous one. updated_at is the time of the last change to
+    # what the card shows, whichever table it came from, for /offers/export
+    op.execute(
+        f"""
+        create function refresh_listing_card(card_id integer)
+        returns void language plpgsql as $$
+        begin
+            perform 1 from housing where id = card_id for no key update;
+            insert into listing_card ({CARD_COLUMNS})
+            {CARD_SELECT.format(updated_at="now()")}
+            where h.id = card_id
+            on conflict (id) do update
+            set ({", ".join(CARD_FIELDS)}, updated_at) = row({CARD_EXCLUDED}, now())
+            where row({CARD_CURRENT}) is distinct from row({CARD_EXCLUDED});
+            -- nothing is written when the card is unchanged or gone
+            if not found then
+                delete from listing_card where id = card_id and not exists (
+                    {CARD_SELECT.format(updated_at="now()")}
+                    where h.id = card_id
+                );
+            end if;
+        end
+        $$
+        """
+    )
+    # tg_argv[0] is the column with the id of the housing
+    op.execute(
+        """
+        create function listing_card_source() returns trigger language plpgsql as $$
+        declare
+            old_id integer := to_jsonb(old) ->> tg_argv[0];
+            new_id integer := to_jsonb(new) ->> tg_argv[0];
+        begin
+            if old_id is not null then
+                perform refresh_listing_card(old_id);
+            end if;
+            if new_id is distinct from old_id then
+                perform refresh_listing_card(new_id);
+            end if;
+            return null;
+        end
+        $$
+        """
+    )
+    for table, column in CARD_SOURCES.items():
+        op.execute(
+            f"""
+            create trigger listing_card_source
+            after insert or update or delete on {table}
+            for each row execute function listing_card_source('{column}')
+            """
+        )
+
+    # renames are copied to the cards without rebuilding them
+    op.execute(
+        """
+        create function listing_card_names() returns trigger language plpgsql as $$
+        begin
+            if tg_table_name = 'housing_category' then
+                update listing_card set category_name = new.name, updated_at = now()
+                where category_id = new.id;
+            elsif tg_table_name = 'housing_type' then
+                update listing_card set type_name = new.name, updated_at = now()
+                where type_id = new.id;
+            else
+                perform refresh_listing_card(housing_id)
+                from characteristic where characteristic_type_id = new.id;
+            end if;
+            return null;
+        end
+        $$
+        """
+    )
+    for table in ("housing_category", "housing_type", "characteristic_type"):
+        op.execute(
+            f"""
+            create trigger listing_card_names after update of name on {table}
+            for each row when (old.name is distinct from new.name)
+            execute function listing_card_names()
+            """
+        )
+
+
+def downgrade():
+    for table in ("housing_category", "housing_type", "characteristic_type"):
+        op.execute(f"drop trigger listing_card_names on {table}")
+    op.execute("drop function listing_card_names()")
+    for table in CARD_SOURCES:
+        op.execute(f"drop trigger listing_card_source on {table}")
+    op.execute("drop function listing_card_source()")
+    op.execute("drop function refresh_listing_card(integer)")
+
+    for name, table, columns in HOUSING_OFFERS_INDEXES:
+        op.create_index(name, table, columns, unique=False)
+    op.drop_index("ix_liked_housing_user_id_housing_id", table_name="liked_housing")
+    op.drop_table("listing_card")
@@ -0,0 +1,187 @@
+"""housing rating aggregates
+
+Revision ID: 51e8eb30b427
+Revises: def4fba14852
+Create Date: 2026-10-18 09:12:40.417206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "51e8eb30b427"
+down_revision = "def4fba14852"
+branch_labels = None
+depends_on = None
+
+RATING_SQL = "case when grade_count > 0 then grade_sum / grade_count else 0 end"
+
+
+def create_rating_table(name, *columns, unique):
+    op.create_table(
+        name,
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column(
+            "created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column(
+            "updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column("grade_sum", sa.Float(), server_default="0", nullable=False),
+        sa.Column("grade_count", sa.Integer(), server_default="0", nullable=False),
+        sa.Column(
+            "rating", sa.Float(), sa.Computed(RATING_SQL, persisted=True), nullable=True
+        ),
+        sa.Column("housing_id", sa.Integer(), nullable=False),
+        *columns,
+        sa.ForeignKeyConstraint(
+            ["housing_id"],
+            ["housing.id"],
+            name="fk_on_housing",
+            onupdate="CASCADE",
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(*unique),
+    )
+
+
+def upgrade():
+    create_rating_table("housing_rating", unique=("housing_id",))
+    op.create_index(
+        "ix_housing_rating_rating_housing_id",
+        "housing_rating",
+        ["rating", "housing_id"],
+        unique=False,
+    )
+    create_rating_table(
+        "housing_review_rating",
+        sa.Column("review_category_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["review_category_id"],
+            ["review_category.id"],
+            name="fk_on_review_category",
+            onupdate="CASCADE",
+            ondelete="CASCADE",
+        ),
+        unique=("housing_id", "review_category_id"),
+    )
+
+    # a housing is graded once per review, not once per category
+    op.drop_constraint(
+        "review_grade_housing_id_review_category_id_key", "review_grade", type_="unique"
+    )
+    op.create_index(
+        "ix_review_grade_housing_id_review_category_id",
+        "review_grade",
+        ["housing_id", "review_category_id"],
+        unique=False,
+    )
+
+    op.execute(
+        """
+        insert into housing_rating (housing_id, grade_sum, grade_count)
+        select housing_id, sum(grade), count(*) from review_grade group by housing_id
+        """
+    )
+    op.execute(
+        """
+        insert into housing_review_rating
+            (housing_id, review_category_id, grade_sum, grade_count)
+        select housing_id, review_category_id, sum(grade), count(*)
+        from review_grade group by housing_id, review_category_id
+        """
+    )
+
+    # adding is an upsert; removing only updates, so the grades deleted by the
+    # cascade of a housing don't recreate the rating rows of that housing
+    op.execute(
+        """
+        create function add_review_grade(
+            graded_housing_id integer, graded_category_id integer, grade double precision
+        ) returns void language plpgsql as $$
+        begin
+            insert into housing_rating as r (housing_id, grade_sum, grade_count)
+            values (graded_housing_id, grade, 1)
+            on conflict (housing_id) do update
+            set grade_sum = r.grade_sum + excluded.grade_sum,
+                grade_count = r.grade_count + 1,
+                updated_at = now();
+            insert into housing_review_rating as r
+                (housing_id, review_category_id, grade_sum, grade_count)
+            values (graded_housing_id, graded_category_id, grade, 1)
+            on conflict (housing_id, review_category_id) do update
+            set grade_sum = r.grade_sum + excluded.grade_sum,
+                grade_count = r.grade_count + 1,
+                updated_at = now();
+        end
+        $$
+        """
+    )
+    op.execute(
+        """
+        create function remove_review_grade(
+            graded_housing_id integer, graded_category_id integer, grade double precision
+        ) returns void language plpgsql as $$
+        begin
+            update housing_rating r
+            set grade_sum = r.grade_sum - grade,
+                grade_count = r.grade_count - 1,
+                updated_at = now()
+            where r.housing_id = graded_housing_id;
+            update housing_review_rating r
+            set grade_sum = r.grade_sum - grade,
+                grade_count = r.grade_count - 1,
+                updated_at = now()
+            where r.housing_id = graded_housing_id
+                and r.review_category_id = graded_category_id;
+        end
+        $$
+        """
+    )
+    op.execute(
+        """
+        create function review_grade_rating() returns trigger language plpgsql as $$
+        begin
+            if tg_op in ('UPDATE', 'DELETE') then
+                perform remove_review_grade(
+                    old.housing_id, old.review_category_id, old.grade
+                );
+            end if;
+            if tg_op in ('INSERT', 'UPDATE') then
+                perform add_review_grade(
+                    new.housing_id, new.review_category_id, new.grade
+                );
+            end if;
+            return null;
+        end
+        $$
+        """
+    )
+    op.execute(
+        """
+        create trigger review_grade_rating
+        after insert or delete or update of housing_id, review_category_id, grade
+        on review_grade for each row execute function review_grade_rating()
+        """
+    )
+
+
+def downgrade():
+    op.execute("drop trigger review_grade_rating on review_grade")
+    op.execute("drop function review_grade_rating()")
+    op.execute("drop function remove_review_grade(integer, integer, double precision)")
+    op.execute("drop function add_review_grade(integer, integer, double precision)")
+
+    op.drop_index(
+        "ix_review_grade_housing_id_review_category_id", table_name="review_grade"
+    )
+    op.create_unique_constraint(
+        "review_grade_housing_id_review_category_id_key",
+        "review_grade",
+        ["housing_id", "review_category_id"],
+    )
+
+    op.drop_table("housing_review_rating")
+    op.drop_index("ix_housing_rating_rating_housing_id", table_name="housing_rating")
+    op.drop_table("housing_rating")
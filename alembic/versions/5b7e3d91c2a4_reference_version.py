@@ -0,0 +1,72 @@
+"""reference version
+
+Revision ID: 5b7e3d91c2a4
+Revises: 2a4e8f47b611
+Create Date: 2026-10-18 17:41:06.284519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "5b7e3d91c2a4"
+down_revision = "2a4e8f47b611"
+branch_labels = None
+depends_on = None
+
+# tables of GET /housing/fields/
+REFERENCE_TABLES = (
+    "housing_type",
+    "characteristic_type",
+    "housing_category",
+    "comfort_category",
+    "comfort",
+    "rule",
+    "feature",
+    "review_category",
+)
+
+
+def upgrade():
+    op.create_table(
+        "reference_version",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column(
+            "created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column(
+            "updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column("version", sa.BigInteger(), server_default="1", nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.execute("insert into reference_version default values")
+
+    # once per statement, so a bulk change costs one update
+    op.execute(
+        """
+        create function bump_reference_version() returns trigger
+        language plpgsql as $$
+        begin
+            update reference_version set version = version + 1, updated_at = now();
+            return null;
+        end
+        $$
+        """
+    )
+    for table in REFERENCE_TABLES:
+        op.execute(
+            f"""
+            create trigger reference_version
+            after insert or update or delete or truncate on {table}
+            for each statement execute function bump_reference_version()
+            """
+        )
+
+
+def downgrade():
+    for table in REFERENCE_TABLES:
+        op.execute(f"drop trigger reference_version on {table}")
+    op.execute("drop function bump_reference_version()")
+
+    op.drop_table("reference_version")
@@ -0,0 +1,99 @@
+"""media file references
+
+Revision ID: 9d2e7b14c6a8
+Revises: 3f9a4c1e7b20
+Create Date: 2026-10-18 12:41:07.208315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "9d2e7b14c6a8"
+down_revision = "3f9a4c1e7b20"
+branch_labels = None
+depends_on = None
+
+# table -> folder of MEDIA_FOLDER and column with the file name
+MEDIA_REFERENCES = {
+    "housing_image": ("housings", "file_name"),
+    '"user"': ("users", "image"),
+}
+
+
+def upgrade():
+    op.create_table(
+        "media_file",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column(
+            "created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column(
+            "updated_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column("path", sa.String(), nullable=False),
+        sa.Column("reference_count", sa.Integer(), server_default="0", nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("path"),
+    )
+    op.create_index(
+        "ix_media_file_unreferenced",
+        "media_file",
+        ["id"],
+        unique=False,
+        postgresql_where=sa.text("reference_count <= 0"),
+    )
+
+    op.execute(
+        "insert into media_file (path, reference_count) "
+        + " union all ".join(
+            f"select '{folder}/' || {column}, count(*) from {table} "
+            f"where {column} is not null group by {column}"
+            for table, (folder, column) in MEDIA_REFERENCES.items()
+        )
+    )
+
+    # tg_argv[0] is the folder, tg_argv[1] the column with the file name
+    op.execute(
+        """
+        create function media_file_reference() returns trigger language plpgsql as $$
+        declare
+            old_name varchar := to_jsonb(old) ->> tg_argv[1];
+            new_name varchar := to_jsonb(new) ->> tg_argv[1];
+        begin
+            if old_name is not distinct from new_name then
+                return null;
+            end if;
+            if old_name is not null then
+                update media_file
+                set reference_count = reference_count - 1, updated_at = now()
+                where path = tg_argv[0] || '/' || old_name;
+            end if;
+            if new_name is not null then
+                insert into media_file as f (path, reference_count)
+                values (tg_argv[0] || '/' || new_name, 1)
+                on conflict (path) do update
+                set reference_count = f.reference_count + 1, updated_at = now();
+            end if;
+            return null;
+        end
+        $$
+        """
+    )
+    for table, (folder, column) in MEDIA_REFERENCES.items():
+        op.execute(
+            f"""
+            create trigger media_file_reference
+            after insert or delete or update of {column} on {table}
+            for each row execute function media_file_reference('{folder}', '{column}')
+            """
+        )
+
+
+def downgrade():
+    for table in MEDIA_REFERENCES:
+        op.execute(f"drop trigger media_file_reference on {table}")
+    op.execute("drop function media_file_reference()")
+
+    op.drop_index("ix_media_file_unreferenced", table_name="media_file")
+    op.drop_table("media_file")
@@ -0,0 +1,210 @@
+import asyncio
+import re
+from copy import copy
+from decimal import Decimal
+from itertools import islice
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterable,
+    Iterator,
+    Tuple,
+    Type,
+    Union,
+)
+
+import orjson
+from fastapi import HTTPException
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute, get_request_handler
+from psycopg2.extras import DateTimeRange
+from sqlalchemy_utils import PhoneNumber
+from starlette.requests import Request
+from starlette import status
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+from core.serializers import datetime_to_str
+
+
+def default(value: Any) -> Any:
+    # types orjson doesn't encode natively
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, PhoneNumber):
+        return value.e164
+    if isinstance(value, DateTimeRange):
+        # same object as range_sql builds in postgres
+        return {
+            "lower": datetime_to_str(value.lower),
+            "upper": datetime_to_str(value.upper),
+            "bounds": ("[" if value.lower_inc else "(")
+            + ("]" if value.upper_inc else ")"),
+        }
+    return jsonable_encoder(value)
+
+
+def dumps(content: Any, option: int = 0) -> bytes:
+    body: bytes = orjson.dumps(
+        content, default=default, option=orjson.OPT_NON_STR_KEYS | option
+    )
+    return body
+
+
+def ndjson_chunks(items: Iterable[Any], size: int = 500) -> Iterator[bytes]:
+    """
+    Newline delimited JSON of `items`, `size` lines per chunk, for
+    StreamingResponse(..., media_type=NDJSON_MEDIA_TYPE)
+    """
+    items = iter(items)
+    while True:
+        chunk = b"".join(
+            dumps(item, orjson.OPT_APPEND_NEWLINE) for item in islice(items, size)
+        )
+        if not chunk:
+            return
+        yield chunk
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def etag_matches(etag: str, if_none_match: Union[str, None]) -> bool:
+    tags = {tag.strip() for tag in (if_none_match or "").split(",")}
+    return bool(tags & {etag, f"W/{etag}", "*"})
+
+
+def etag_response(
+    body: bytes, etag: str, if_none_match: Union[str, None] = None
+) -> Response:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def byte_range(
+    range_header: Union[str, None], size: int
+) -> Union[Tuple[int, int], None]:
+    """
+    :return: start and end (exclusive) of the range of a Range header; None
+     when the whole body is sent: no header, several ranges or an invalid one
+    :raises HTTPException: 416 when the range starts past the end
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", (range_header or "").strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # the last `last` bytes
+        start, end = max(size - int(last), 0), size
+    else:
+        start, end = int(first), min(int(last) + 1, size) if last else size
+        if last and int(last) < start:
+            return None
+    if start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+def file_response(
+    stream: Callable[[int, int], Iterator[bytes]],
+    size: int,
+    media_type: str,
+    headers: Dict[str, str],
+    if_none_match: Union[str, None] = None,
+    range_header: Union[str, None] = None,
+    if_range: Union[str, None] = None,
+) -> Response:
+    """
+    Response with the bytes of a file which stream(start, end) reads; 304
+    when If-None-Match has the ETag of headers, 206 with a range of Range
+    unless If-Range names another version
+    """
+    etag = headers["ETag"]
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    headers = {**headers, "Accept-Ranges": "bytes"}
+    ranged = None if if_range not in (None, etag) else byte_range(range_header, size)
+    if ranged is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(
+            stream(0, size), media_type=media_type, headers=headers
+        )
+    start, end = ranged
+    headers["Content-Length"] = str(end - start)
+    headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    return StreamingResponse(
+        stream(start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class ORJSONRoute(APIRoute):
+    """
+    Routes without a response_model which return plain dicts and lists hand
+    them straight to ORJSONResponse, skipping the jsonable_encoder pass
+    FastAPI runs over every returned value.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        response_class: Type[Response]
+        if isinstance(self.response_class, DefaultPlaceholder):
+            response_class = self.response_class.value
+        else:
+            response_class = self.response_class
+
+        dependant = self.dependant
+        if self.response_model is None and issubclass(response_class, ORJSONResponse):
+            dependant = copy(dependant)
+            dependant.call = self.encode_result(dependant.call, response_class)
+
+        handler: Callable[[Request], Coroutine[Any, Any, Response]]
+        handler = get_request_handler(
+            dependant=dependant,
+            body_field=self.body_field,
+            status_code=self.status_code,
+            response_class=self.response_class,
+            response_field=self.secure_cloned_response_field,
+            response_model_include=self.response_model_include,
+            response_model_exclude=self.response_model_exclude,
+            response_model_by_alias=self.response_model_by_alias,
+            response_model_exclude_unset=self.response_model_exclude_unset,
+            response_model_exclude_defaults=self.response_model_exclude_defaults,
+            response_model_exclude_none=self.response_model_exclude_none,
+            dependency_overrides_provider=self.dependency_overrides_provider,
+        )
+        return handler
+
+    def encode_result(self, call: Any, response_class: type) -> Callable:
+        status_code = self.status_code or 200
+
+        def as_response(result: Any) -> Any:
+            if isinstance(result, Response):
+                return result
+            return response_class(content=result, status_code=status_code)
+
+        if asyncio.iscoroutinefunction(call):
+
+            async def async_endpoint(**values: Any) -> Any:
+                return as_response(await call(**values))
+
+            return async_endpoint
+
+        def endpoint(**values: Any) -> Any:
+            return as_response(call(**values))
+
+        return endpoint
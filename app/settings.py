@@ -28,7 +28,22 @@ def get_db() -> sessionmaker:
         db.close()
 
 
+# bytes of listing documents kept by GET /housing/{housing_id}
+HOUSING_CACHE_BYTES = int(os.environ.get("HOUSING_CACHE_BYTES", 32 * 1024 * 1024))
+# largest accepted housing and user image upload
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", 20 * 1024 * 1024))
+# processes which resize uploaded images
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+# users whose liked housing ids are kept for the hearts of /offers
+LIKED_IDS_CACHE_USERS = int(os.environ.get("LIKED_IDS_CACHE_USERS", 10000))
+
 MEDIA_FOLDER = "media"
+MEDIA_URL = "/media"
+# backend of the files of MEDIA_FOLDER: "local", "pack" or "memory"
+MEDIA_STORAGE = os.environ.get("MEDIA_STORAGE", "local")
+# internal nginx location of MEDIA_FOLDER: media stored as files of their own
+# is sent by nginx through X-Accel-Redirect, empty to send it from the app
+MEDIA_ACCEL_PREFIX = os.environ.get("MEDIA_ACCEL_PREFIX", "")
 if not os.path.exists(f"{MEDIA_FOLDER}"):
     os.mkdir(f"{MEDIA_FOLDER}")
     os.mkdir(f"{MEDIA_FOLDER}/housings")
@@ -24,11 +24,12 @@ from auth.services import (
     delete_user_image_,
     create_user_image_,
 )
+from app.responses import ORJSONRoute
 from auth.database import get_user_by_email, create_user, change_user_data
 from auth.token import create_access_token, get_current_user
 from core.models import User, LikedHousing
 
-router = APIRouter(prefix="/user", tags=["authentication"])
+router = APIRouter(prefix="/user", tags=["authentication"], route_class=ORJSONRoute)
 
 # GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID") or None
 # GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET") or None
@@ -206,7 +207,7 @@ async def create_user_image(
     image: UploadFile = File(...),
 ) -> dict:
     await create_user_image_(image, user, db)
-    return user.as_dict()
+    return user.as_dict(extra_fields=["image_urls"])
 
 
 @router.delete("/image")
@@ -225,4 +226,4 @@ async def get_user(
     other_user: User = db.query(User).filter(User.id == user_id).first()
     if not other_user:
         return {"detail": "User not found"}
-    return other_user.as_dict()
+    return other_user.as_dict(extra_fields=["image_urls"])
@@ -1,24 +1,34 @@
-import os
-import uuid
-from typing import Union
+from typing import Union, Any
 
 from fastapi import UploadFile
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from app.settings import MEDIA_FOLDER
-from core.models import LikedHousing, User, Housing, HousingImage
-from core.services import save_image
+from core.models import LikedHousing, ListingCard, User
+from core.serializers import get_serializer
+from core.services import (
+    card_as_dict,
+    liked_housing_ids,
+    receive_image,
+    store_image,
+)
+from core.storage import release_files
+
+liked_housing_serializer = get_serializer(LikedHousing)
+
+
+def wish_as_dict(row: Any) -> dict:
+    like = liked_housing_serializer(row.LikedHousing)
+    like["housing"] = card_as_dict(row.ListingCard)
+    return like
 
 
 def get_wishlist_(user: User, db: Session) -> Union[list, None]:
     query = (
-        db.query(LikedHousing, Housing, HousingImage)
+        db.query(LikedHousing, ListingCard)
         .filter(
             LikedHousing.user_id == user.id,
-            LikedHousing.housing_id == Housing.id,
-            HousingImage.housing_id == Housing.id,
-            HousingImage.is_main == True,
+            LikedHousing.housing_id == ListingCard.id,
         )
         .all()
     )
@@ -26,14 +36,7 @@ def get_wishlist_(user: User, db: Session) -> Union[list, None]:
     if not query:
         return None
 
-    result = []
-    for row in query:
-        housing = row.Housing.as_dict()
-        housing["main_image"] = row.HousingImage.as_dict()
-        like: dict = row.LikedHousing.as_dict()
-        like["housing"] = housing
-        result.append(like)
-    return result
+    return [wish_as_dict(row) for row in query]
 
 
 def get_wish_(
@@ -44,25 +47,21 @@ def get_wish_(
 ) -> Union[dict, None]:
     if housing_id:
         query = (
-            db.query(LikedHousing, Housing, HousingImage)
+            db.query(LikedHousing, ListingCard)
             .filter(
                 LikedHousing.user_id == user.id,
-                Housing.id == housing_id,
                 LikedHousing.housing_id == housing_id,
-                HousingImage.housing_id == housing_id,
-                HousingImage.is_main == True,
+                ListingCard.id == housing_id,
             )
             .first()
         )
     elif liked_housing_id:
         query = (
-            db.query(LikedHousing, Housing, HousingImage)
+            db.query(LikedHousing, ListingCard)
             .filter(
                 LikedHousing.user_id == user.id,
                 LikedHousing.id == liked_housing_id,
-                LikedHousing.housing_id == Housing.id,
-                HousingImage.housing_id == Housing.id,
-                HousingImage.is_main == True,
+                LikedHousing.housing_id == ListingCard.id,
             )
             .first()
         )
@@ -72,11 +71,7 @@ def get_wish_(
     if not query:
         return None
 
-    housing: dict = query.Housing.as_dict()
-    housing["main_image"] = query.HousingImage.as_dict()
-    like: dict = query.LikedHousing.as_dict()
-    like["housing"] = housing
-    return like
+    return wish_as_dict(query)
 
 
 def create_wishlist_(
@@ -88,6 +83,7 @@ def create_wishlist_(
         db.commit()
     except IntegrityError:
         return None
+    liked_housing_ids.invalidate(user.id)
     return liked_housing
 
 
@@ -122,21 +118,18 @@ def delete_wishlist_(
 
     db.delete(liked_housing)
     db.commit()
+    liked_housing_ids.invalidate(user.id)
     return liked_housing
 
 
 async def create_user_image_(image: UploadFile, user: User, db: Session) -> User:
-    if user.image:
-        delete_user_image_(user, db)
-    file_name = f'{uuid.uuid4()}.{image.filename.split(".")[-1]}'
-    user.image = file_name
-    db.add(user)
-    db.commit()
-
-    file_path = f"{MEDIA_FOLDER}/users/{file_name}"
-
-    await save_image(file_path, image)
+    received = await receive_image(image)
 
+    old_image = user.image
+    user.image = received.file_name
+    db.add(user)
+    await store_image("users", received, db)
+    release_files("users", [old_image], db)
     return user
 
 
@@ -144,11 +137,8 @@ def delete_user_image_(user: User, db: Session) -> None:
     if not user.image:
         return None
 
-    file_path = f"{MEDIA_FOLDER}/users/{user.image}"
-    try:
-        os.remove(file_path)
-    except FileNotFoundError:
-        print(FileNotFoundError)
+    old_image = user.image
     user.image = None
     db.add(user)
     db.commit()
+    release_files("users", [old_image], db)
@@ -4,6 +4,8 @@ from typing import Any, Union, Tuple, Callable, Dict
 from fastapi.testclient import TestClient
 from requests import Response  # type: ignore
 
+from core.backends import MemoryStorage
+from core.storage import use_media_storage
 from main import app
 
 client = TestClient(app)
@@ -40,15 +42,18 @@ def auth_and_create_user() -> Tuple[str, str, dict, Response, str]:
 def auth(func: Callable) -> Callable:
     def wrapper() -> None:
         email, password, headers, response, token = auth_and_create_user()
-        kwargs = {
-            "email": email,
-            "password": password,
-            "headers": headers,
-            "response": response,
-            "token": token,
-        }
-        func(**kwargs)
-        delete(headers=headers)
+        # uploads of the test are kept in memory, not in MEDIA_FOLDER
+        with use_media_storage(MemoryStorage()) as storage:
+            kwargs = {
+                "email": email,
+                "password": password,
+                "headers": headers,
+                "response": response,
+                "token": token,
+                "storage": storage,
+            }
+            func(**kwargs)
+            delete(headers=headers)
 
     return wrapper
 
@@ -1,14 +1,15 @@
 import os
 from datetime import datetime, timedelta
-from typing import Union
+from typing import Optional, Union
 
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
+from sqlalchemy.orm import Session
 from starlette import status
 
 from core.models import User
-from app.settings import Session, get_db
+from app.settings import get_db
 from auth.database import get_user_by_email
 from auth.hashed import verify_password
 from auth.scheme import TokenData
@@ -20,6 +21,7 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="user/login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="user/login", auto_error=False)
 
 
 def create_access_token(data: dict) -> str:
@@ -57,3 +59,19 @@ async def get_current_user(
         raise credentials_exception
 
     return get_user_by_email(db, token_data.email)
+
+
+async def get_optional_user(
+    data: Optional[str] = Depends(optional_oauth2_scheme),
+    db: Session = Depends(get_db),
+) -> Optional[User]:
+    """
+    The user of the request on public routes, None when the request has no
+    valid token
+    """
+    if data is None:
+        return None
+    token_data = verify_token(data)
+    if not isinstance(token_data, TokenData):
+        return None
+    return get_user_by_email(db, token_data.email)
@@ -3,6 +3,7 @@ from typing import Any, Union, Dict, List, Optional
 from fastapi import APIRouter, WebSocket, Request, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
 
+from app.responses import ORJSONRoute
 from chat.services import (
     add_message_,
     get_chats_with_last_message_by_user,
@@ -14,6 +15,7 @@ from core.models import User
 router = APIRouter(
     prefix="/chat",
     tags=["chat"],
+    route_class=ORJSONRoute,
 )
 
 
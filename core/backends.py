@@ -0,0 +1,389 @@
+"""
+Backends which store the files of MEDIA_FOLDER by key, their path relative to
+it: <kind>/<file name> for uploads and <kind>/derived/<file name>/<variant>
+for their derivatives. A key names immutable content, so put keeps a file
+which is stored already.
+"""
+import fcntl
+import io
+import json
+import mmap
+import os
+import shutil
+import stat
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, suppress
+from typing import BinaryIO, Dict, Iterator, NamedTuple, Tuple, Union
+
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+class StoredFile(NamedTuple):
+    size: int
+    # unix time of the put
+    modified: float
+
+
+class MediaStorage(ABC):
+    @abstractmethod
+    def put(self, key: str, source: BinaryIO) -> None:
+        """
+        Stores source from its current position to its end, unless key is
+        stored already
+        """
+
+    @abstractmethod
+    def get(self, key: str) -> Union[bytes, None]:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def stat(self, key: str) -> Union[StoredFile, None]:
+        pass
+
+    @abstractmethod
+    def stream(
+        self, key: str, start: int = 0, end: Union[int, None] = None
+    ) -> Iterator[bytes]:
+        """
+        :return: chunks of the bytes from start up to end, the end of the
+         file by default
+        :raises FileNotFoundError: when key isn't stored
+        """
+
+    def is_file(self, key: str) -> bool:
+        """
+        :return: whether key is stored as a file of its own at
+         <folder>/<key>, which a web server can send
+        """
+        return False
+
+    def copy(self, source_key: str, key: str) -> bool:
+        """
+        :return: False when source_key isn't stored
+        """
+        content = self.get(source_key)
+        if content is None:
+            return False
+        self.put(key, io.BytesIO(content))
+        return True
+
+
+def slice_chunks(
+    content: Union[bytes, mmap.mmap], start: int, end: int
+) -> Iterator[bytes]:
+    for offset in range(start, end, STREAM_CHUNK_BYTES):
+        yield content[offset : min(offset + STREAM_CHUNK_BYTES, end)]
+
+
+class LocalStorage(MediaStorage):
+    """
+    A file per key in folder
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+
+    def path(self, key: str) -> str:
+        return f"{self.folder}/{key}"
+
+    def put(self, key: str, source: BinaryIO) -> None:
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # concurrent puts of a key write files of their own, the file appears
+        # at path only once it's complete
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(partial_path, "wb") as file:
+                shutil.copyfileobj(source, file, STREAM_CHUNK_BYTES)
+            os.replace(partial_path, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(partial_path)
+            raise
+
+    def get(self, key: str) -> Union[bytes, None]:
+        try:
+            with open(self.path(key), "rb") as file:
+                return file.read()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+    def delete(self, key: str) -> None:
+        with suppress(FileNotFoundError):
+            os.remove(self.path(key))
+        # folders left empty go too, e.g. the one of the derivatives of an
+        # image, but not the folder of a kind
+        folder = os.path.dirname(key)
+        while "/" in folder:
+            try:
+                os.rmdir(self.path(folder))
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+    def stat(self, key: str) -> Union[StoredFile, None]:
+        try:
+            result = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        if not stat.S_ISREG(result.st_mode):
+            return None
+        return StoredFile(result.st_size, result.st_mtime)
+
+    def is_file(self, key: str) -> bool:
+        return self.stat(key) is not None
+
+    def stream(
+        self, key: str, start: int = 0, end: Union[int, None] = None
+    ) -> Iterator[bytes]:
+        with open(self.path(key), "rb") as file:
+            if end is None:
+                end = os.fstat(file.fileno()).st_size
+            file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = file.read(min(STREAM_CHUNK_BYTES, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def copy(self, source_key: str, key: str) -> bool:
+        path = self.path(key)
+        if os.path.exists(path):
+            return True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(self.path(source_key), path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # e.g. folder spans file systems
+            return super().copy(source_key, key)
+        return True
+
+
+class MemoryStorage(MediaStorage):
+    """
+    Files of one process, for tests
+    """
+
+    def __init__(self) -> None:
+        self._files: Dict[str, Tuple[bytes, float]] = {}
+        self._lock = threading.Lock()
+
+    def put(self, key: str, source: BinaryIO) -> None:
+        content = source.read()
+        with self._lock:
+            self._files.setdefault(key, (content, time.time()))
+
+    def get(self, key: str) -> Union[bytes, None]:
+        with self._lock:
+            stored = self._files.get(key)
+        return None if stored is None else stored[0]
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._files.pop(key, None)
+
+    def stat(self, key: str) -> Union[StoredFile, None]:
+        with self._lock:
+            stored = self._files.get(key)
+        return None if stored is None else StoredFile(len(stored[0]), stored[1])
+
+    def stream(
+        self, key: str, start: int = 0, end: Union[int, None] = None
+    ) -> Iterator[bytes]:
+        content = self.get(key)
+        if content is None:
+            raise FileNotFoundError(key)
+        return slice_chunks(content, start, len(content) if end is None else end)
+
+
+class PackEntry(NamedTuple):
+    segment: int
+    offset: int
+    size: int
+    modified: float
+
+
+class PackStorage(MediaStorage):
+    """
+    Appends files of at most max_packed_bytes, i.e. derivatives and small
+    uploads, to segment files of at most segment_bytes in folder, which are
+    read through mmap; larger files are left to `large`. A put costs no inode
+    of its own, and the space of deleted files stays in their segments.
+
+    index.log has a JSON line per put or delete of a packed file. Writers
+    append to the last segment and to the log under an flock of the log;
+    every process reads the lines appended by the others on each lookup.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        large: MediaStorage,
+        max_packed_bytes: int = 512 * 1024,
+        segment_bytes: int = 256 * 1024 * 1024,
+    ) -> None:
+        self.folder = folder
+        self.large = large
+        self.max_packed_bytes = max_packed_bytes
+        self.segment_bytes = segment_bytes
+        self._entries: Dict[str, PackEntry] = {}
+        # bytes of index.log read into _entries
+        self._index_offset = 0
+        self._last_segment = 1
+        # a map is replaced, never closed: streams may still read the old one
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._lock = threading.RLock()
+        os.makedirs(folder, exist_ok=True)
+        self._index_path = f"{folder}/index.log"
+
+    def _segment_path(self, segment: int) -> str:
+        return f"{self.folder}/{segment:08d}.pack"
+
+    def _read_index(self) -> None:
+        try:
+            with open(self._index_path, "rb") as index:
+                index.seek(self._index_offset)
+                appended = index.read()
+        except FileNotFoundError:
+            return
+        # a line being written by another process is read once it's complete
+        complete = appended[: appended.rfind(b"\n") + 1]
+        self._index_offset += len(complete)
+        for line in complete.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # left by a writer which died mid line
+                continue
+            if record.get("deleted"):
+                self._entries.pop(record["key"], None)
+                continue
+            self._entries[record["key"]] = PackEntry(
+                record["segment"], record["offset"], record["size"], record["modified"]
+            )
+            self._last_segment = max(self._last_segment, record["segment"])
+
+    @contextmanager
+    def _index_writer(self) -> Iterator[BinaryIO]:
+        with self._lock, open(self._index_path, "a+b") as index:
+            # released when the file is closed
+            fcntl.flock(index, fcntl.LOCK_EX)
+            self._read_index()
+            size = index.seek(0, os.SEEK_END)
+            if size:
+                index.seek(size - 1)
+                if index.read(1) != b"\n":
+                    index.write(b"\n")
+            yield index
+            index.flush()
+
+    def _entry(self, key: str) -> Union[PackEntry, None]:
+        with self._lock:
+            self._read_index()
+            return self._entries.get(key)
+
+    def _map(self, entry: PackEntry) -> Union[mmap.mmap, bytes]:
+        if entry.size == 0:
+            # an empty file can't be mapped
+            return b""
+        with self._lock:
+            segment_map = self._maps.get(entry.segment)
+            # the last segment grows after it's mapped
+            if segment_map is None or len(segment_map) < entry.offset + entry.size:
+                with open(self._segment_path(entry.segment), "rb") as segment:
+                    segment_map = mmap.mmap(
+                        segment.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+                self._maps[entry.segment] = segment_map
+            return segment_map
+
+    def put(self, key: str, source: BinaryIO) -> None:
+        if self.stat(key) is not None:
+            return
+        position = source.tell()
+        content = source.read(self.max_packed_bytes + 1)
+        if len(content) > self.max_packed_bytes:
+            source.seek(position)
+            self.large.put(key, source)
+            return
+
+        with self._index_writer() as index:
+            if key in self._entries:
+                return
+            segment = self._last_segment
+            with suppress(FileNotFoundError):
+                size = os.path.getsize(self._segment_path(segment))
+                if size + len(content) > self.segment_bytes:
+                    segment += 1
+            with open(self._segment_path(segment), "ab") as file:
+                # bytes of a writer which died before logging them are skipped
+                offset = file.seek(0, os.SEEK_END)
+                file.write(content)
+            entry = PackEntry(segment, offset, len(content), time.time())
+            index.write(json.dumps({"key": key, **entry._asdict()}).encode() + b"\n")
+            self._entries[key] = entry
+            self._last_segment = segment
+
+    def get(self, key: str) -> Union[bytes, None]:
+        entry = self._entry(key)
+        if entry is None:
+            return self.large.get(key)
+        return self._map(entry)[entry.offset : entry.offset + entry.size]
+
+    def delete(self, key: str) -> None:
+        if self._entry(key) is None:
+            self.large.delete(key)
+            return
+        with self._index_writer() as index:
+            if self._entries.pop(key, None) is not None:
+                index.write(json.dumps({"key": key, "deleted": True}).encode() + b"\n")
+
+    def stat(self, key: str) -> Union[StoredFile, None]:
+        entry = self._entry(key)
+        if entry is None:
+            return self.large.stat(key)
+        return StoredFile(entry.size, entry.modified)
+
+    def stream(
+        self, key: str, start: int = 0, end: Union[int, None] = None
+    ) -> Iterator[bytes]:
+        entry = self._entry(key)
+        if entry is None:
+            return self.large.stream(key, start, end)
+        # the bytes past the entry are the ones of the next file in the segment
+        end = entry.size if end is None else min(end, entry.size)
+        return slice_chunks(self._map(entry), entry.offset + start, entry.offset + end)
+
+    def is_file(self, key: str) -> bool:
+        return self._entry(key) is None and self.large.is_file(key)
+
+    def copy(self, source_key: str, key: str) -> bool:
+        if self._entry(source_key) is None:
+            return self.large.copy(source_key, key)
+        return super().copy(source_key, key)
+
+
+def make_storage(backend: str, folder: str) -> MediaStorage:
+    """
+    :param backend: "local", "pack" or "memory"
+    """
+    if backend == "local":
+        return LocalStorage(folder)
+    if backend == "pack":
+        return PackStorage(f"{folder}/packs", LocalStorage(folder))
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown media storage {backend}")
@@ -0,0 +1,225 @@
+"""
+Microbenchmarks of hot paths, run with
+
+    python -m core.benchmarks [name ...]
+
+They work on transient objects, so no database is needed.
+"""
+import sys
+import timeit
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Union
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from app.responses import ORJSONResponse
+from core.models import (
+    Characteristic,
+    CharacteristicType,
+    Housing,
+    HousingCategory,
+    HousingImage,
+    HousingPricing,
+    HousingType,
+)
+from core.pricing import MONTH_NIGHTS, WEEK_NIGHTS, quote
+from core.serializers import get_serializer
+
+
+def legacy_as_dict(
+    obj: Any,
+    fields: Union[list, None] = None,
+    extend: Union[list, None] = None,
+    extra_fields: Union[list, None] = None,
+) -> dict:
+    # BaseMixin.as_dict before serializers were compiled
+    if extra_fields is None:
+        extra_fields = []
+    self_dict: dict = {}
+
+    fields = [column.name for column in obj.__table__.columns] if not fields else fields
+    extend = list(obj.hidden_fields) + (extend or [])
+
+    for field in set(fields + extra_fields) - set(extend):
+        if hasattr(obj, field):
+            attr = getattr(obj, field)
+
+            if isinstance(attr, datetime):
+                self_dict[field] = str(attr)
+            elif hasattr(attr, "__table__"):
+                self_dict[field] = legacy_as_dict(attr)
+            elif isinstance(attr, list):
+                self_dict[field] = [legacy_as_dict(obj) for obj in attr]
+            else:
+                self_dict[field] = attr
+
+    return self_dict
+
+
+def make_offer(housing_id: int) -> Housing:
+    now = datetime.now()
+    housing: Housing = Housing(
+        id=housing_id,
+        created_at=now,
+        updated_at=now,
+        name=f"housing {housing_id}",
+        description="description",
+        address="address",
+        status=False,
+        category_id=1,
+        type_id=1,
+        user_id=1,
+    )
+    # every column is set, as on objects loaded from the database
+    housing.category = HousingCategory(
+        id=1, created_at=now, updated_at=now, name="Apartment", level=0, parent_id=0
+    )
+    housing.type = HousingType(
+        id=1, created_at=now, updated_at=now, name="Entire place", description="-"
+    )
+    housing.pricing = HousingPricing(
+        id=housing_id,
+        created_at=now,
+        updated_at=now,
+        per_night=100,
+        cleaning=10,
+        service=5,
+        discount_per_week=10,
+        discount_per_month=20,
+        housing_id=housing_id,
+    )
+    housing.characteristics = [
+        Characteristic(
+            id=housing_id * 4 + number,
+            created_at=now,
+            updated_at=now,
+            amount=number,
+            housing_id=housing_id,
+            characteristic_type=CharacteristicType(
+                id=number, created_at=now, updated_at=now, name=name
+            ),
+            characteristic_type_id=number,
+        )
+        for number, name in enumerate(("guests", "bedrooms", "beds", "baths"))
+    ]
+    housing.housing_images = [
+        HousingImage(
+            id=housing_id,
+            created_at=now,
+            updated_at=now,
+            housing_id=housing_id,
+            file_name="1.jpg",
+            is_main=True,
+        )
+    ]
+    return housing
+
+
+def bench_serializers(number: int = 2000) -> Dict[str, float]:
+    """seconds per dumped /offers listing"""
+    extra_fields = ["characteristics", "category", "pricing", "type"]
+    offer = make_offer(1)
+    serializer = get_serializer(Housing, extra_fields=extra_fields)
+    assert serializer(offer) == legacy_as_dict(offer, extra_fields=extra_fields)
+
+    return {
+        "legacy as_dict": timeit.timeit(
+            lambda: legacy_as_dict(offer, extra_fields=extra_fields), number=number
+        )
+        / number,
+        "compiled serializer": timeit.timeit(lambda: serializer(offer), number=number)
+        / number,
+    }
+
+
+def bench_encoders(number: int = 50) -> Dict[str, float]:
+    """seconds per encoded 500-listing /offers page"""
+    serializer = get_serializer(
+        Housing, extra_fields=["characteristics", "category", "pricing", "type"]
+    )
+    page = {
+        "offers": [
+            {**serializer(offer), "main_image": "1.jpg"}
+            for offer in map(make_offer, range(1, 501))
+        ],
+        "next_cursor": "WyJuZXdlc3QiLCBudWxsLCAxXQ==",
+    }
+    assert ORJSONResponse(page).body == JSONResponse(jsonable_encoder(page)).body
+
+    return {
+        "jsonable_encoder + json": timeit.timeit(
+            lambda: JSONResponse(jsonable_encoder(page)), number=number
+        )
+        / number,
+        "orjson": timeit.timeit(lambda: ORJSONResponse(page), number=number) / number,
+    }
+
+
+def python_quotes(pricing: list, nights: int) -> List[dict]:
+    # per listing loop, as the frontend computes totals
+    quotes = []
+    for per_night, cleaning, service, discount_per_week, discount_per_month in pricing:
+        subtotal = per_night * nights
+        percent = 0
+        if nights >= MONTH_NIGHTS:
+            percent = discount_per_month
+        elif nights >= WEEK_NIGHTS:
+            percent = discount_per_week
+        discount = round(subtotal * percent / 100, 2)
+        quotes.append(
+            {
+                "subtotal": subtotal,
+                "discount": discount,
+                "cleaning": cleaning,
+                "service": service,
+                "total": subtotal - discount + cleaning + service,
+            }
+        )
+    return quotes
+
+
+def bench_quotes(number: int = 200) -> Dict[str, float]:
+    """seconds per quoted 500-listing search page"""
+    rng = np.random.default_rng(0)
+    pricing = np.column_stack(
+        [
+            rng.integers(10, 10000, 500),
+            rng.integers(0, 100, 500),
+            rng.integers(0, 100, 500),
+            rng.integers(0, 30, 500),
+            rng.integers(0, 50, 500),
+        ]
+    )
+    rows = pricing.tolist()
+    nights = 10
+    quotes = quote(pricing, nights)
+    for name, column in quotes.items():
+        assert np.allclose(column, [row[name] for row in python_quotes(rows, nights)])
+
+    return {
+        "python loop": timeit.timeit(lambda: python_quotes(rows, nights), number=number)
+        / number,
+        "numpy": timeit.timeit(lambda: quote(pricing, nights), number=number) / number,
+    }
+
+
+BENCHMARKS: Dict[str, Callable[[], Dict[str, float]]] = {
+    "serializers": bench_serializers,
+    "encoders": bench_encoders,
+    "quotes": bench_quotes,
+}
+
+
+def main(names: list) -> None:
+    for name in names or BENCHMARKS:
+        results = BENCHMARKS[name]()
+        baseline = next(iter(results.values()))
+        print(name)
+        for label, seconds in results.items():
+            print(f"  {label:<24} {seconds * 1e6:10.2f} us  x{baseline / seconds:.1f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
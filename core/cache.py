@@ -0,0 +1,181 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    NamedTuple,
+    Tuple,
+    Union,
+)
+
+from sqlalchemy.orm import Session
+
+from app.responses import dumps
+
+
+class CachedBody(NamedTuple):
+    body: bytes
+    etag: str
+    version: int
+
+
+def make_etag(body: bytes) -> str:
+    # derived from the content, so every worker serves the same tag
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+class ReferenceCache:
+    """
+    Pre-serialized JSON of rarely changing tables, shared by every request of
+    the process. It is served while `version` returns the version it was
+    loaded at; triggers on the tables bump it on every change, so writes of
+    every process are seen at once.
+    """
+
+    def __init__(
+        self, load: Callable[[Session], Any], version: Callable[[Session], int]
+    ) -> None:
+        self.load = load
+        self.version = version
+        self._entry: Union[CachedBody, None] = None
+        self._lock = threading.Lock()
+
+    def get(self, db: Session) -> CachedBody:
+        # read before loading, so a change committed meanwhile is loaded again
+        version = self.version(db)
+        entry = self._entry
+        if entry is not None and entry.version == version:
+            return entry
+
+        with self._lock:
+            entry = self._entry
+            if entry is not None and entry.version == version:
+                return entry
+            body = dumps(self.load(db))
+            entry = CachedBody(body, make_etag(body), version)
+            # a slower load of an older version doesn't replace a newer one
+            if self._entry is None or self._entry.version < version:
+                self._entry = entry
+            return entry
+
+
+class CachedDocument(NamedTuple):
+    version: int
+    body: bytes
+    etag: str
+
+
+class DocumentCache:
+    """
+    LRU of encoded documents by id, bounded by the total size of the bodies.
+    A document is served while its version is the current one, which readers
+    look up in the database, so writes of every process are seen at once.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._documents: "OrderedDict[int, CachedDocument]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(
+        self,
+        key: int,
+        version: int,
+        load: Callable[[], Union[Tuple[int, bytes], None]],
+    ) -> Union[CachedDocument, None]:
+        """
+        :param version: current version of the document
+        :param load: builds (version, body) of the document, None if it
+         doesn't exist
+        """
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None and document.version == version:
+                self._documents.move_to_end(key)
+                self.hits += 1
+                return document
+            self.misses += 1
+
+        loaded = load()
+        if loaded is None:
+            return None
+        version, body = loaded
+        document = CachedDocument(version, body, f'"{key}-{version}"')
+
+        with self._lock:
+            cached = self._documents.get(key)
+            # a slower load of an older version doesn't replace a newer one
+            newer = cached is None or cached.version < version
+            if newer and len(body) <= self.max_bytes:
+                self._remove(key)
+                self._documents[key] = document
+                self._size += len(body)
+                while self._size > self.max_bytes:
+                    self._remove(next(iter(self._documents)))
+                    self.evictions += 1
+        return document
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "documents": len(self._documents),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, key: int) -> bool:
+        document = self._documents.pop(key, None)
+        if document is None:
+            return False
+        self._size -= len(document.body)
+        return True
+
+
+class IdSetCache:
+    """
+    LRU of id sets by key, at most max_keys of them, e.g. the liked housings
+    of a user. Writers call invalidate(key) after committing; max_age bounds
+    how long writes made by other processes stay unseen.
+    """
+
+    def __init__(self, max_keys: int, max_age: float = 30.0) -> None:
+        self.max_keys = max_keys
+        self.max_age = max_age
+        self._sets: "OrderedDict[int, Tuple[FrozenSet[int], float]]" = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: int, load: Callable[[], Iterable[int]]) -> FrozenSet[int]:
+        with self._lock:
+            entry = self._sets.get(key)
+            if entry is not None:
+                if time.monotonic() - entry[1] < self.max_age:
+                    self._sets.move_to_end(key)
+                    return entry[0]
+                del self._sets[key]
+            generation = self._generation
+
+        ids = frozenset(load())
+
+        with self._lock:
+            # an invalidation while loading may have been missed by the load
+            if generation == self._generation:
+                self._sets[key] = (ids, time.monotonic())
+                while len(self._sets) > self.max_keys:
+                    self._sets.popitem(last=False)
+        return ids
+
+    def invalidate(self, key: int) -> None:
+        with self._lock:
+            self._generation += 1
+            self._sets.pop(key, None)
@@ -0,0 +1,195 @@
+import asyncio
+import io
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from operator import itemgetter
+from typing import BinaryIO, Dict, Tuple, Union
+
+from PIL import Image, ImageOps
+
+from app.settings import MEDIA_URL
+from core.backends import MediaStorage
+
+# longest edge of every derivative, the image is never enlarged
+IMAGE_SIZES: Dict[str, int] = {"card": 480, "gallery": 1280, "full": 2560}
+# extension -> Pillow format and save options
+IMAGE_FORMATS: Dict[str, Tuple[str, dict]] = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", {"quality": 82, "optimize": True, "progressive": True}),
+}
+# <size>.<extension> of every derivative
+IMAGE_VARIANTS = tuple(
+    f"{size}.{extension}" for size in IMAGE_SIZES for extension in IMAGE_FORMATS
+)
+# folders of MEDIA_FOLDER with uploaded images
+IMAGE_KINDS = ("housings", "users")
+# raised by Pillow for content it can't or won't decode, e.g. an unknown
+# format, a truncated file or a decompression bomb
+IMAGE_ERRORS = (OSError, SyntaxError, ValueError, Image.DecompressionBombError)
+
+
+def derived_key(key: str, variant: str) -> str:
+    # housings/<file name> -> housings/derived/<file name>/<variant>, where
+    # the file name may have folders of its own
+    kind, file_name = key.split("/", 1)
+    return f"{kind}/derived/{file_name}/{variant}"
+
+
+def image_urls(
+    kind: str, file_name: Union[str, None]
+) -> Union[Dict[str, Dict[str, str]], None]:
+    """
+    :return: size -> extension -> URL of the derivatives of an uploaded image
+    """
+    if file_name is None:
+        return None
+    return {
+        size: {
+            extension: f"{MEDIA_URL}/{kind}/derived/{file_name}/{size}.{extension}"
+            for extension in IMAGE_FORMATS
+        }
+        for size in IMAGE_SIZES
+    }
+
+
+def image_urls_sql(kind: str, file_name: str) -> str:
+    """
+    SQL json_build_object(...) with the value of image_urls(kind, file_name)
+    """
+    sizes = []
+    for size in IMAGE_SIZES:
+        urls = ", ".join(
+            f"'{extension}', '{MEDIA_URL}/{kind}/derived/' || {file_name} "
+            f"|| '/{size}.{extension}'"
+            for extension in IMAGE_FORMATS
+        )
+        sizes.append(f"'{size}', json_build_object({urls})")
+    return (
+        f"case when {file_name} is not null "
+        f"then json_build_object({', '.join(sizes)}) end"
+    )
+
+
+def image_key(kind: str, file_name: str) -> Union[str, None]:
+    """
+    :return: storage key of an uploaded image, None if the request names
+     none
+    """
+    if kind not in IMAGE_KINDS or any(
+        not part or part.startswith(".") for part in file_name.split("/")
+    ):
+        return None
+    return f"{kind}/{file_name}"
+
+
+def variant_key(kind: str, file_name: str, variant: str) -> Union[str, None]:
+    """
+    :param variant: <size>.<extension> of a derivative
+    :return: storage key of the derivative, None if the request names no
+     derivative of an uploaded image
+    """
+    key = image_key(kind, file_name)
+    if key is None or variant not in IMAGE_VARIANTS:
+        return None
+    return derived_key(key, variant)
+
+
+def is_image(source: BinaryIO) -> bool:
+    """
+    Checks the header and size of an image without decoding its pixels and
+    rewinds source
+    """
+    try:
+        with Image.open(source) as image:
+            image.verify()
+    except IMAGE_ERRORS:
+        return False
+    finally:
+        source.seek(0)
+    return True
+
+
+def make_derivatives(content: bytes) -> Dict[str, bytes]:
+    """
+    Encodes every size and format of an image. Runs in the worker processes
+    of DerivativePool.
+
+    :return: variant -> encoded derivative
+    """
+    largest = max(IMAGE_SIZES.values())
+    with Image.open(io.BytesIO(content)) as image:
+        # JPEGs are decoded at the smallest scale which still covers `largest`
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+
+    derivatives = {}
+    # each size is resized from the previous, larger one
+    for size, edge in sorted(IMAGE_SIZES.items(), key=itemgetter(1), reverse=True):
+        image.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+        for extension, (image_format, options) in IMAGE_FORMATS.items():
+            encoded = io.BytesIO()
+            image.save(encoded, image_format, **options)
+            derivatives[f"{size}.{extension}"] = encoded.getvalue()
+    return derivatives
+
+
+class DerivativePool:
+    """
+    Process pool of at most max_workers processes which runs
+    make_derivatives, so decoding and encoding never hold an API worker. A
+    thread per process reads the image from storage and stores what the
+    process made. Images already being processed aren't submitted twice.
+    """
+
+    def __init__(self, max_workers: int, storage: MediaStorage) -> None:
+        self.max_workers = max_workers
+        self.storage = storage
+        self._executor: Union[ProcessPoolExecutor, None] = None
+        self._threads: Union[ThreadPoolExecutor, None] = None
+        self._pending: Dict[str, Future] = {}
+        # reentrant: a future which is already done runs its callback in submit
+        self._lock = threading.RLock()
+
+    def submit(self, key: str) -> Future:
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                if self._executor is None or self._threads is None:
+                    # forking a process with running threads may copy held locks
+                    self._executor = ProcessPoolExecutor(
+                        self.max_workers, multiprocessing.get_context("spawn")
+                    )
+                    self._threads = ThreadPoolExecutor(self.max_workers)
+                # the storage of the submit, which may be replaced meanwhile
+                future = self._threads.submit(
+                    self._derive, self._executor, self.storage, key
+                )
+                self._pending[key] = future
+                future.add_done_callback(lambda _: self._forget(key))
+            return future
+
+    async def run(self, key: str) -> None:
+        await asyncio.wrap_future(self.submit(key))
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None and self._threads is not None:
+                self._threads.shutdown()
+                self._executor.shutdown()
+                self._executor = self._threads = None
+
+    def _derive(
+        self, executor: ProcessPoolExecutor, storage: MediaStorage, key: str
+    ) -> None:
+        content = storage.get(key)
+        if content is None:
+            raise FileNotFoundError(key)
+        derivatives = executor.submit(make_derivatives, content).result()
+        # in the order of IMAGE_VARIANTS, so the last one marks a complete set
+        for variant in IMAGE_VARIANTS:
+            storage.put(derived_key(key, variant), io.BytesIO(derivatives[variant]))
+
+    def _forget(self, key: str) -> None:
+        with self._lock:
+            self._pending.pop(key, None)
@@ -1,9 +1,10 @@
 from datetime import datetime, time, date
 from decimal import Decimal
-from typing import Optional, List, Union, Any
+from typing import Optional, List, Union, Any, Tuple, Dict
 
 from psycopg2._range import DateTimeRange
 from sqlalchemy import (
+    BigInteger,
     Column,
     Integer,
     String,
@@ -17,15 +18,21 @@ from sqlalchemy import (
     Text,
     UniqueConstraint,
     ForeignKeyConstraint,
+    Index,
+    Computed,
+    LargeBinary,
     func as python_func,
 )
-from sqlalchemy.dialects.postgresql import TSRANGE
+from sqlalchemy.dialects.postgresql import ARRAY, ExcludeConstraint, TSRANGE, TSVECTOR
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship, DeclarativeMeta, Mapped, registry
-from sqlalchemy.sql import func
+from sqlalchemy.orm import relationship, DeclarativeMeta, Mapped, registry, deferred
+from sqlalchemy.sql import func, text, false
 from sqlalchemy_utils import PhoneNumber
 from sqlalchemy_utils.types.email import EmailType
 
+from core.images import image_urls
+from core.serializers import serialize
+
 mapper_registry = registry()
 
 
@@ -45,33 +52,16 @@ class BaseMixin(object):
         DateTime, server_default=func.now(), onupdate=python_func.now()
     )
 
+    # columns which are never dumped by as_dict
+    hidden_fields: Tuple[str, ...] = ()
+
     def as_dict(
         self,
         fields: Union[list, None] = None,
         extend: Union[list, None] = None,
         extra_fields: Union[list, None] = None,
     ) -> dict:
-        if extra_fields is None:
-            extra_fields = []
-        self_dict: dict = {}
-
-        fields = [column.name for column in self.__table__.columns] if not fields else fields  # type: ignore
-        extend = [] if not extend else extend
-
-        for field in set(fields + extra_fields) - set(extend):
-            if hasattr(self, field):
-                attr = getattr(self, field)
-
-                if isinstance(attr, datetime):
-                    self_dict[field] = str(attr)
-                elif isinstance(attr, BaseMixin):
-                    self_dict[field] = attr.as_dict()
-                elif isinstance(attr, list):
-                    self_dict[field] = [obj.as_dict() for obj in attr]
-                else:
-                    self_dict[field] = attr
-
-        return self_dict
+        return serialize(self, fields, extend, extra_fields)
 
 
 class Housing(Base, BaseMixin):
@@ -98,6 +88,7 @@ class Housing(Base, BaseMixin):
             ondelete="CASCADE",
             onupdate="CASCADE",
         ),
+        Index("ix_housing_search_vector", "search_vector", postgresql_using="gin"),
     )
 
     name: str = Column(String(50), nullable=False)
@@ -105,6 +96,21 @@ class Housing(Base, BaseMixin):
     address: str = Column(String, nullable=False)
     status: Optional[bool] = Column(Boolean, nullable=False, default=False)
 
+    hidden_fields = ("search_vector",)
+
+    # full-text search document, kept in sync by postgres on insert and update
+    search_vector: Any = deferred(
+        Column(
+            TSVECTOR,
+            Computed(
+                "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+                "setweight(to_tsvector('english', coalesce(address, '')), 'B') || "
+                "setweight(to_tsvector('english', coalesce(description, '')), 'C')",
+                persisted=True,
+            ),
+        )
+    )
+
     # must be required
     category_id: int = Column(Integer, nullable=False)
     type_id: int = Column(Integer, nullable=False)
@@ -116,6 +122,12 @@ class Housing(Base, BaseMixin):
     pricing: "HousingPricing" = relationship(
         "HousingPricing", back_populates="housing", uselist=False
     )
+    nights: "HousingNights" = relationship(
+        "HousingNights", back_populates="housing", uselist=False
+    )
+    rating: "HousingRating" = relationship(
+        "HousingRating", back_populates="housing", uselist=False
+    )
     category: "HousingCategory" = relationship(
         "HousingCategory", back_populates="housings", uselist=False
     )
@@ -133,6 +145,13 @@ class Housing(Base, BaseMixin):
     review_grades: List["ReviewGrade"] = relationship(
         "ReviewGrade", back_populates="housing", uselist=True, collection_class=list
     )
+    review_ratings: List["HousingReviewRating"] = relationship(
+        "HousingReviewRating",
+        back_populates="housing",
+        uselist=True,
+        collection_class=list,
+        order_by="HousingReviewRating.review_category_id",
+    )
     requests: List["HousingRequest"] = relationship(
         "HousingRequest", back_populates="housing", uselist=True, collection_class=list
     )
@@ -210,6 +229,13 @@ class Characteristic(Base, BaseMixin):
             ondelete="CASCADE",
             onupdate="CASCADE",
         ),
+        # "at least N guests/bedrooms/..." filters of /offers
+        Index(
+            "ix_characteristic_type_id_amount_housing_id",
+            "characteristic_type_id",
+            "amount",
+            "housing_id",
+        ),
     )
 
     amount: int = Column(Integer, nullable=False, default=0)
@@ -298,6 +324,7 @@ class HousingType(Base, BaseMixin):
 class HousingCalendar(Base, BaseMixin):
     __tablename__ = "housing_calendar"
     __table_args__ = (
+        Index("ix_housing_calendar_during", "during", postgresql_using="gist"),
         UniqueConstraint(
             "housing_id",
         ),
@@ -333,6 +360,49 @@ class HousingCalendar(Base, BaseMixin):
         )
 
 
+class HousingNights(Base, BaseMixin):
+    """
+    Nightly prices and availability of a housing, one row per housing with
+    arrays indexed by nights since `start`, so any window is a one row read
+    """
+
+    __tablename__ = "housing_nights"
+    __table_args__ = (
+        UniqueConstraint(
+            "housing_id",
+        ),
+        CheckConstraint(
+            "octet_length(blocked) * 8 >= cardinality(prices)",
+            name="check_blocked_length",
+        ),
+        ForeignKeyConstraint(
+            ("housing_id",),
+            ("housing.id",),
+            name="fk_on_housing",
+            ondelete="CASCADE",
+            onupdate="CASCADE",
+        ),
+    )
+
+    start: date = Column(Date, nullable=False)
+    # price of each night, null for the per_night of the housing pricing
+    prices: List[Optional[int]] = Column(ARRAY(Integer), nullable=False)
+    # bit per night, most significant first, set when the night is blocked
+    blocked: bytes = Column(LargeBinary, nullable=False)
+
+    housing_id: int = Column(Integer, nullable=False)
+
+    housing: Housing = relationship("Housing", back_populates="nights", uselist=False)
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__}("
+            f"id={self.id}, "
+            f"start='{self.start}', "
+            f"housing='{self.housing}')>"
+        )
+
+
 class HousingPricing(Base, BaseMixin):
     __tablename__ = "housing_pricing"
     __table_args__ = (
@@ -460,7 +530,8 @@ class ReviewGrade(Base, BaseMixin):
     __tablename__ = "review_grade"
     __table_args__ = (
         CheckConstraint("grade >= 0 and grade <= 5"),
-        UniqueConstraint(
+        Index(
+            "ix_review_grade_housing_id_review_category_id",
             "housing_id",
             "review_category_id",
         ),
@@ -501,6 +572,101 @@ class ReviewGrade(Base, BaseMixin):
         )
 
 
+# expression of the average grade of rating rows, 0 while nothing is graded
+RATING_SQL = "case when grade_count > 0 then grade_sum / grade_count else 0 end"
+
+
+class HousingRating(Base, BaseMixin):
+    """
+    Running sum and count of every review grade of a housing, kept in sync by
+    the triggers on review_grade in the transaction which writes the grades
+    """
+
+    __tablename__ = "housing_rating"
+    __table_args__ = (
+        UniqueConstraint(
+            "housing_id",
+        ),
+        ForeignKeyConstraint(
+            ("housing_id",),
+            ("housing.id",),
+            name="fk_on_housing",
+            ondelete="CASCADE",
+            onupdate="CASCADE",
+        ),
+    )
+
+    hidden_fields = ("grade_sum",)
+
+    grade_sum: float = Column(Float, nullable=False, server_default="0")
+    grade_count: int = Column(Integer, nullable=False, server_default="0")
+    rating: float = Column(Float, Computed(RATING_SQL, persisted=True))
+
+    housing_id: int = Column(Integer, nullable=False)
+
+    housing: Housing = relationship("Housing", back_populates="rating", uselist=False)
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__}("
+            f"id={self.id}, "
+            f"rating='{self.rating}', "
+            f"grade_count='{self.grade_count}', "
+            f"housing='{self.housing}')>"
+        )
+
+
+class HousingReviewRating(Base, BaseMixin):
+    """
+    Running sum and count of the grades of a housing in one review category,
+    kept in sync like HousingRating
+    """
+
+    __tablename__ = "housing_review_rating"
+    __table_args__ = (
+        UniqueConstraint(
+            "housing_id",
+            "review_category_id",
+        ),
+        ForeignKeyConstraint(
+            ("housing_id",),
+            ("housing.id",),
+            name="fk_on_housing",
+            ondelete="CASCADE",
+            onupdate="CASCADE",
+        ),
+        ForeignKeyConstraint(
+            ("review_category_id",),
+            ("review_category.id",),
+            name="fk_on_review_category",
+            ondelete="CASCADE",
+            onupdate="CASCADE",
+        ),
+    )
+
+    hidden_fields = ("grade_sum",)
+
+    grade_sum: float = Column(Float, nullable=False, server_default="0")
+    grade_count: int = Column(Integer, nullable=False, server_default="0")
+    rating: float = Column(Float, Computed(RATING_SQL, persisted=True))
+
+    housing_id: int = Column(Integer, nullable=False)
+    review_category_id: int = Column(Integer, nullable=False)
+
+    housing: Housing = relationship(
+        "Housing", back_populates="review_ratings", uselist=False
+    )
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__}("
+            f"id={self.id}, "
+            f"rating='{self.rating}', "
+            f"review_category_id='{self.review_category_id}', "
+            f"housing='{self.housing}')>"
+        )
+
+
 class User(Base, BaseMixin):
     __tablename__ = "user"
     __table_args__ = (
@@ -528,6 +694,8 @@ class User(Base, BaseMixin):
     image: Optional[str] = Column(String)
     password: str = Column(Text, nullable=False)
 
+    hidden_fields = ("password",)
+
     housings: List[Housing] = relationship(
         "Housing", back_populates="user", uselist=True, collection_class=list
     )
@@ -546,6 +714,10 @@ class User(Base, BaseMixin):
         "LikedHousing", back_populates="user", uselist=True, collection_class=list
     )
 
+    @property
+    def image_urls(self) -> Union[Dict[str, Dict[str, str]], None]:
+        return image_urls("users", self.image)
+
     def __repr__(self) -> str:
         return (
             f"<{self.__class__.__name__}("
@@ -555,35 +727,28 @@ class User(Base, BaseMixin):
             f"email='{self.email}')>"
         )
 
-    def as_dict(
-        self,
-        fields: Union[list, None] = None,
-        extend: Union[list, None] = None,
-        extra_fields: Union[list, None] = None,
-    ) -> dict:
-        return super(User, self).as_dict(
-            fields=fields,
-            extend=extend + ["password"] if extend else ["password"],
-            extra_fields=extra_fields,
-        )
-
 
 class HousingRequest(Base, BaseMixin):
     __tablename__ = "request"
     __table_args__ = (
+        # accepted requests of a housing never overlap (needs btree_gist), its
+        # index also serves availability checks
+        ExcludeConstraint(
+            ("housing_id", "="),
+            ("during", "&&"),
+            name="excl_request_housing_id_during_accepted",
+            using="gist",
+            where=text("accepted"),
+        ),
         CheckConstraint(
             "number_of_guests > 0 and number_of_guests < 10",
             name="check_numbers_of_guests",
         ),
-        UniqueConstraint(
-            "housing_id",
-            "user_id",
-        ),
         ForeignKeyConstraint(
             ("housing_id",),
             ("housing.id",),
             name="fk_on_housing",
-            ondelete="SET NULL",
+            ondelete="CASCADE",
             onupdate="CASCADE",
         ),
         ForeignKeyConstraint(
@@ -597,7 +762,10 @@ class HousingRequest(Base, BaseMixin):
 
     during: DateTimeRange = Column(TSRANGE(), nullable=False)
     number_of_guests: int = Column(Integer, nullable=False)
-    message: str = Column(String)
+    message: Optional[str] = Column(String)
+    accepted: bool = Column(
+        Boolean, nullable=False, default=False, server_default=false()
+    )
 
     housing_id: int = Column(Integer, nullable=False)
     user_id: int = Column(Integer, nullable=False)
@@ -620,6 +788,7 @@ class HousingRequest(Base, BaseMixin):
 class HousingHistory(Base, BaseMixin):
     __tablename__ = "housing_history"
     __table_args__ = (
+        Index("ix_housing_history_during", "during", postgresql_using="gist"),
         UniqueConstraint(
             "housing_id",
             "user_id",
@@ -968,6 +1137,12 @@ class HousingImage(Base, BaseMixin):
     __tablename__ = "housing_image"
     __table_args__ = (
         UniqueConstraint("housing_id", "is_main"),
+        Index(
+            "ix_housing_image_main_housing_id",
+            "housing_id",
+            "file_name",
+            postgresql_where=text("is_main"),
+        ),
         ForeignKeyConstraint(
             ("housing_id",),
             ("housing.id",),
@@ -985,6 +1160,10 @@ class HousingImage(Base, BaseMixin):
         "Housing", back_populates="housing_images", uselist=False
     )
 
+    @property
+    def urls(self) -> Union[Dict[str, Dict[str, str]], None]:
+        return image_urls("housings", self.file_name)
+
     def __repr__(self) -> str:
         return (
             f"<{self.__class__.__name__}("
@@ -997,6 +1176,8 @@ class LikedHousing(Base, BaseMixin):
     __tablename__ = "liked_housing"
     __table_args__ = (
         UniqueConstraint("housing_id", "user_id"),
+        # wishlist of a user
+        Index("ix_liked_housing_user_id_housing_id", "user_id", "housing_id"),
         ForeignKeyConstraint(
             ("housing_id",),
             ("housing.id",),
@@ -1027,3 +1208,146 @@ class LikedHousing(Base, BaseMixin):
             f"housing='{self.housing}', "
             f"user='{self.housing}', "
         )
+
+
+class ListingCard(Base, BaseMixin):
+    """
+    What /offers and the wishlist show of a housing, one row per housing with
+    a main image. Rows are rebuilt by triggers on every table the card is
+    read from, in the transaction which changes them; id and created_at are
+    the ones of the housing, updated_at is the time of the last change to the
+    card.
+    """
+
+    __tablename__ = "listing_card"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ("id",),
+            ("housing.id",),
+            name="fk_on_housing",
+            ondelete="CASCADE",
+            onupdate="CASCADE",
+        ),
+        # keyset pagination of /offers by "newest", "price" and "rating"
+        Index("ix_listing_card_created_at_id", "created_at", "id"),
+        Index("ix_listing_card_per_night_id", "per_night", "id"),
+        Index("ix_listing_card_rating_id", "rating", "id"),
+        # filtered /offers
+        Index(
+            "ix_listing_card_category_id_created_at_id",
+            "category_id",
+            "created_at",
+            "id",
+        ),
+        Index("ix_listing_card_type_id_created_at_id", "type_id", "created_at", "id"),
+        # incremental /offers/export
+        Index("ix_listing_card_updated_at_id", "updated_at", "id"),
+    )
+
+    id: int = Column(Integer, primary_key=True, autoincrement=False)
+
+    name: str = Column(String(50), nullable=False)
+    address: str = Column(String, nullable=False)
+    category_id: int = Column(Integer, nullable=False)
+    category_name: str = Column(String(50), nullable=False)
+    type_id: int = Column(Integer, nullable=False)
+    type_name: str = Column(String(50), nullable=False)
+    main_image: Optional[str] = Column(String, nullable=True)
+    per_night: Optional[int] = Column(Integer, nullable=True)
+
+    # amounts of the characteristics of CHARACTERISTIC_FILTERS
+    guests: Optional[int] = Column(Integer, nullable=True)
+    bedrooms: Optional[int] = Column(Integer, nullable=True)
+    beds: Optional[int] = Column(Integer, nullable=True)
+    baths: Optional[int] = Column(Integer, nullable=True)
+
+    rating: float = Column(Float, nullable=False, server_default="0")
+    rating_count: int = Column(Integer, nullable=False, server_default="0")
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__}("
+            f"id={self.id}, "
+            f"name='{self.name}', "
+            f"category_name='{self.category_name}', "
+            f"type_name='{self.type_name}')>"
+        )
+
+
+class MediaFile(Base, BaseMixin):
+    """
+    A content addressed file of MEDIA_FOLDER and the number of housing_image
+    and user rows which reference it, kept in sync by triggers on them. The
+    file is removed by the transaction which deletes the row, once the count
+    drops to 0.
+    """
+
+    __tablename__ = "media_file"
+    __table_args__ = (
+        UniqueConstraint("path"),
+        # files left by rows deleted without releasing them, e.g. by cascades
+        Index(
+            "ix_media_file_unreferenced",
+            "id",
+            postgresql_where=text("reference_count <= 0"),
+        ),
+    )
+
+    # <kind>/<file name>, relative to MEDIA_FOLDER
+    path: str = Column(String, nullable=False)
+    reference_count: int = Column(Integer, nullable=False, server_default="0")
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__}("
+            f"id={self.id}, "
+            f"path='{self.path}', "
+            f"reference_count={self.reference_count})>"
+        )
+
+
+class HousingVersion(Base, BaseMixin):
+    """
+    Counter of the changes to the GET /housing/{housing_id} document of a
+    housing, bumped by triggers on every table the document is read from in
+    the transaction which changes them
+    """
+
+    __tablename__ = "housing_version"
+    __table_args__ = (
+        UniqueConstraint("housing_id"),
+        ForeignKeyConstraint(
+            ("housing_id",),
+            ("housing.id",),
+            name="fk_on_housing",
+            ondelete="CASCADE",
+            onupdate="CASCADE",
+        ),
+    )
+
+    housing_id: int = Column(Integer, nullable=False)
+    version: int = Column(BigInteger, nullable=False, server_default="1")
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__}("
+            f"id={self.id}, "
+            f"housing_id={self.housing_id}, "
+            f"version={self.version})>"
+        )
+
+
+class ReferenceVersion(Base, BaseMixin):
+    """
+    Single row counting the changes to the reference tables of GET
+    /housing/fields/, bumped by a trigger per statement on each of them
+    """
+
+    __tablename__ = "reference_version"
+
+    version: int = Column(BigInteger, nullable=False, server_default="1")
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__}(" f"id={self.id}, " f"version={self.version})>"
+        )
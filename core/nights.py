@@ -0,0 +1,72 @@
+from datetime import date, timedelta
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# nights which can be read at once and stored ahead of today
+MAX_NIGHTS = 2 * 366
+
+
+class Nights:
+    """
+    Nightly prices and blocked flags from `start`, unpacked from a
+    HousingNights row into arrays: prices are floats with nan for the
+    default price of the housing.
+    """
+
+    __slots__ = ("start", "prices", "blocked")
+
+    def __init__(self, start: date, prices: np.ndarray, blocked: np.ndarray) -> None:
+        self.start = start
+        self.prices = prices
+        self.blocked = blocked
+
+    @classmethod
+    def unpack(
+        cls, start: date, prices: List[Optional[int]], blocked: bytes
+    ) -> "Nights":
+        # None becomes nan
+        prices_array = np.array(prices, dtype=np.float64)
+        blocked_array = np.unpackbits(
+            np.frombuffer(blocked, dtype=np.uint8), count=len(prices_array)
+        ).astype(bool)
+        return cls(start, prices_array, blocked_array)
+
+    @classmethod
+    def empty(cls, start: date) -> "Nights":
+        return cls(start, np.empty(0), np.empty(0, dtype=bool))
+
+    def pack(self) -> Tuple[date, List[Optional[int]], bytes]:
+        prices = [
+            None if np.isnan(price) else int(price) for price in self.prices.tolist()
+        ]
+        return self.start, prices, np.packbits(self.blocked).tobytes()
+
+    @property
+    def end(self) -> date:
+        return self.start + timedelta(days=len(self.prices))
+
+    def window(self, start: date, end: date) -> "Nights":
+        """
+        :return: nights from start to end, nights which aren't stored have the
+         default price and aren't blocked
+        """
+        offset = (start - self.start).days
+        length = (end - start).days
+        return Nights(
+            start,
+            reindex(self.prices, np.nan, offset, length),
+            reindex(self.blocked, False, offset, length),
+        )
+
+
+def reindex(values: np.ndarray, fill: object, offset: int, length: int) -> np.ndarray:
+    """
+    :return: values[offset:offset + length], padded with `fill` outside of
+     `values`
+    """
+    result = np.full(length, fill, dtype=values.dtype)
+    low, high = max(offset, 0), min(offset + length, len(values))
+    if low < high:
+        result[low - offset : high - offset] = values[low:high]
+    return result
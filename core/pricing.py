@@ -0,0 +1,69 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# columns of the pricing matrix, in the order of HousingPricing
+PRICING_FIELDS = (
+    "per_night",
+    "cleaning",
+    "service",
+    "discount_per_week",
+    "discount_per_month",
+)
+QUOTE_FIELDS = ("subtotal", "discount", "cleaning", "service", "total")
+
+WEEK_NIGHTS = 7
+MONTH_NIGHTS = 28
+
+
+def discount_column(nights: int) -> int:
+    """
+    :return: index of the discount which applies to a stay of `nights`, the
+     monthly one replaces the weekly one, -1 when there is none
+    """
+    if nights >= MONTH_NIGHTS:
+        return PRICING_FIELDS.index("discount_per_month")
+    if nights >= WEEK_NIGHTS:
+        return PRICING_FIELDS.index("discount_per_week")
+    return -1
+
+
+def quote(
+    pricing: np.ndarray, nights: int, night_prices: Optional[np.ndarray] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Prices a stay of `nights` at every listing at once.
+
+    :param pricing: (listings, len(PRICING_FIELDS)) matrix of pricing rows
+    :param night_prices: (listings, n) matrix of the prices hosts set for n of
+     the nights, nan where the night costs per_night
+    :return: QUOTE_FIELDS -> array with one amount per listing; cleaning and
+     service are fees per stay, the discount is a percent of the subtotal
+    """
+    pricing = np.asarray(pricing, dtype=np.float64).reshape(-1, len(PRICING_FIELDS))
+    subtotal = pricing[:, 0] * nights
+    if night_prices is not None and night_prices.size:
+        # nansum of an all-nan row is 0
+        subtotal += np.nansum(night_prices - pricing[:, :1], axis=1)
+    column = discount_column(nights)
+    if column < 0:
+        discount = np.zeros_like(subtotal)
+    else:
+        discount = np.round(subtotal * pricing[:, column] / 100, 2)
+    cleaning = pricing[:, 1]
+    service = pricing[:, 2]
+    return {
+        "subtotal": subtotal,
+        "discount": discount,
+        "cleaning": cleaning,
+        "service": service,
+        "total": subtotal - discount + cleaning + service,
+    }
+
+
+def quotes_as_dicts(housing_ids: List[int], nights: int, quotes: dict) -> List[dict]:
+    columns = [quotes[name].tolist() for name in QUOTE_FIELDS]
+    return [
+        {"housing_id": housing_id, "nights": nights, **dict(zip(QUOTE_FIELDS, row))}
+        for housing_id, *row in zip(housing_ids, *columns)
+    ]
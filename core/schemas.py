@@ -1,3 +1,4 @@
+from datetime import date
 from typing import Optional, List, Dict, Union
 
 from pydantic import BaseModel
@@ -47,6 +48,74 @@ class HouseChange(BaseModel):
     per_night: Optional[int]
 
 
+class PricingChange(BaseModel):
+    housing_id: int
+    per_night: Optional[int]
+    cleaning: Optional[int]
+    service: Optional[int]
+    discount_per_week: Optional[int]
+    discount_per_month: Optional[int]
+
+
+class PricingAdjustment(BaseModel):
+    housing_ids: List[int]
+    # percents, e.g. 10 raises the price by 10% and -10 lowers it
+    per_night: Optional[float]
+    cleaning: Optional[float]
+    service: Optional[float]
+    discount_per_week: Optional[float]
+    discount_per_month: Optional[float]
+
+
+class HousingPricingChange(BaseModel):
+    # new values, applied before the adjustments
+    prices: List[PricingChange] = []
+    adjustments: List[PricingAdjustment] = []
+
+
+class NightsSpan(BaseModel):
+    # nights from start to end, end excluded
+    start: date
+    end: date
+    price: Optional[int]
+    # back to the per_night of the housing pricing
+    reset_price: bool = False
+    available: Optional[bool]
+
+
+class NightsChange(BaseModel):
+    spans: List[NightsSpan]
+
+
+class RequestCreate(BaseModel):
+    housing_id: int
+    check_in: date
+    check_out: date
+    number_of_guests: int
+    message: Optional[str]
+
+
+class OfferFilters(BaseModel):
+    # full-text query over name, address and description
+    q: Optional[str]
+    category_id: Optional[int]
+    type_id: Optional[int]
+    price_min: Optional[int]
+    price_max: Optional[int]
+    # minimum amounts of characteristics
+    guests: Optional[int]
+    bedrooms: Optional[int]
+    beds: Optional[int]
+    baths: Optional[int]
+    # free for the whole stay
+    check_in: Optional[date]
+    check_out: Optional[date]
+
+
+class SearchFilters(OfferFilters):
+    q: str
+
+
 class ComfortCategoryCreate(BaseModel):
     name: str
 
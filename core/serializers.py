@@ -0,0 +1,200 @@
+from datetime import datetime
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Tuple, Union
+
+from sqlalchemy import DateTime, inspect
+from sqlalchemy.dialects.postgresql.ranges import RangeOperators
+
+Converter = Callable[[Any], Any]
+
+_serializers: Dict[tuple, "Serializer"] = {}
+
+
+def datetime_to_str(value: Any) -> Any:
+    return str(value) if value is not None else None
+
+
+def convert_any(value: Any) -> Any:
+    # fallback for attributes which are not columns or relationships
+    if isinstance(value, datetime):
+        return str(value)
+    if hasattr(value, "__table__"):
+        return serialize(value)
+    if isinstance(value, list):
+        return [serialize(obj) for obj in value]
+    return value
+
+
+def relationship_converter(model: type, uselist: bool) -> Converter:
+    nested: List[Serializer] = []
+
+    # the nested serializer is compiled on the first call, so that models
+    # referencing each other don't recurse while compiling
+    def get_nested() -> Serializer:
+        if not nested:
+            nested.append(get_serializer(model))
+        return nested[0]
+
+    if uselist:
+        return lambda value: [get_nested()(obj) for obj in value]
+    return lambda value: get_nested()(value) if value is not None else None
+
+
+def tuple_getter(getter: Callable, names: List[str]) -> Callable[[Any], tuple]:
+    if not names:
+        return lambda obj: ()
+    if len(names) == 1:
+        get_one = getter(names[0])
+        return lambda obj: (get_one(obj),)
+    return getter(*names)  # type: ignore
+
+
+class Serializer:
+    """
+    Dumps model instances to dicts with the same output as the dynamic
+    BaseMixin.as_dict. Field names and per-field converters are resolved once
+    per shape, so dumping an object is a single itemgetter call on the loaded
+    state plus the converters of the fields which need one.
+    """
+
+    __slots__ = ("plain_fields", "get_plain", "get_loaded", "converted_fields")
+
+    def __init__(
+        self,
+        model: type,
+        fields: Union[Iterable[str], None] = None,
+        extend: Iterable[str] = (),
+        extra_fields: Iterable[str] = (),
+    ) -> None:
+        table_columns = model.__table__.columns  # type: ignore
+        mapper = inspect(model)
+        relationships = mapper.relationships
+        hidden = set(extend) | set(getattr(model, "hidden_fields", ()))
+
+        names = list(fields) if fields else [column.name for column in table_columns]
+        plain: List[str] = []
+        converted: List[Tuple[str, Converter]] = []
+
+        for name in dict.fromkeys(names + list(extra_fields)):
+            if name in hidden or not hasattr(model, name):
+                continue
+            if name in relationships:
+                relationship = relationships[name]
+                converted.append(
+                    (
+                        name,
+                        relationship_converter(
+                            relationship.mapper.class_, relationship.uselist
+                        ),
+                    )
+                )
+            elif name in table_columns:
+                if isinstance(table_columns[name].type, DateTime):
+                    converted.append((name, datetime_to_str))
+                else:
+                    plain.append(name)
+            else:
+                converted.append((name, convert_any))
+
+        self.plain_fields: Tuple[str, ...] = tuple(plain)
+        self.converted_fields: Tuple[Tuple[str, Converter], ...] = tuple(converted)
+        self.get_plain: Callable[[Any], tuple] = tuple_getter(attrgetter, plain)
+        self.get_loaded: Callable[[Any], tuple] = tuple_getter(itemgetter, plain)
+
+    def __call__(self, obj: Any) -> dict:
+        # loaded attributes are read from the instance dict, bypassing the
+        # instrumented descriptors; expired and deferred ones go through
+        # getattr, which loads them
+        state = obj.__dict__
+        try:
+            result = dict(zip(self.plain_fields, self.get_loaded(state)))
+        except KeyError:
+            result = dict(zip(self.plain_fields, self.get_plain(obj)))
+        for name, convert in self.converted_fields:
+            result[name] = convert(state[name] if name in state else getattr(obj, name))
+        return result
+
+    def from_mapping(self, row: Mapping[str, Any]) -> dict:
+        """
+        Dumps a row of the model's table, e.g. from INSERT/UPDATE ... RETURNING
+        """
+        result = dict(zip(self.plain_fields, self.get_loaded(row)))
+        for name, convert in self.converted_fields:
+            result[name] = convert(row[name])
+        return result
+
+    def many(self, objs: Iterable[Any]) -> List[dict]:
+        return [self(obj) for obj in objs]
+
+
+def get_serializer(
+    model: type,
+    fields: Union[Iterable[str], None] = None,
+    extend: Union[Iterable[str], None] = None,
+    extra_fields: Union[Iterable[str], None] = None,
+) -> Serializer:
+    key = (
+        model,
+        tuple(fields) if fields else None,
+        tuple(extend) if extend else (),
+        tuple(extra_fields) if extra_fields else (),
+    )
+    serializer = _serializers.get(key)
+    if serializer is None:
+        serializer = _serializers[key] = Serializer(model, *key[1:])
+    return serializer
+
+
+def serialize(
+    obj: Any,
+    fields: Union[Iterable[str], None] = None,
+    extend: Union[Iterable[str], None] = None,
+    extra_fields: Union[Iterable[str], None] = None,
+) -> dict:
+    return get_serializer(type(obj), fields, extend, extra_fields)(obj)
+
+
+def datetime_sql(value: str) -> str:
+    # same text as str(datetime): microseconds are omitted when they are zero
+    return (
+        f"regexp_replace(to_char({value}, 'YYYY-MM-DD HH24:MI:SS.US'), "
+        "'\\.000000$', '')"
+    )
+
+
+def range_sql(value: str) -> str:
+    return (
+        f"json_build_object('lower', {datetime_sql(f'lower({value})')}, "
+        f"'upper', {datetime_sql(f'upper({value})')}, "
+        f"'bounds', case when lower_inc({value}) then '[' else '(' end || "
+        f"case when upper_inc({value}) then ']' else ')' end)"
+    )
+
+
+def json_object_sql(
+    model: type,
+    alias: str,
+    extend: Iterable[str] = (),
+    extra_fields: Union[Dict[str, str], None] = None,
+) -> str:
+    """
+    SQL json_build_object(...) of a row of `model` with the keys and value
+    formats of its default serializer, so postgres can assemble documents
+    which look like the ones dumped in python.
+
+    :param extra_fields: key -> SQL expression, e.g. subqueries of children
+    """
+    hidden = set(extend) | set(getattr(model, "hidden_fields", ()))
+    pairs = []
+    for column in model.__table__.columns:  # type: ignore
+        if column.name in hidden:
+            continue
+        value = f'{alias}."{column.name}"'
+        if isinstance(column.type, DateTime):
+            value = datetime_sql(value)
+        elif isinstance(column.type, RangeOperators):
+            value = range_sql(value)
+        pairs.append(f"'{column.name}', {value}")
+    for name, value in (extra_fields or {}).items():
+        pairs.append(f"'{name}', {value}")
+    return f"json_build_object({', '.join(pairs)})"
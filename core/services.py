@@ -1,14 +1,59 @@
-import os
-import uuid
-from typing import Union, Any
+import base64
+import binascii
+import hashlib
+import json
+import typing
+from functools import partial
+from datetime import datetime, date, time, timedelta
+from typing import (
+    Union,
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Tuple,
+    Type,
+)
 
+import numpy as np
 from fastapi import UploadFile, HTTPException
+from psycopg2 import errorcodes
+from psycopg2.extras import DateTimeRange
+from sqlalchemy import (
+    Float,
+    Integer,
+    and_,
+    cast,
+    column,
+    exists,
+    func,
+    insert,
+    or_,
+    select,
+    text,
+    true,
+    tuple_,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import TSRANGE, insert as pg_insert
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, Query
 from starlette import status
+from starlette.concurrency import run_in_threadpool
 
-from app.settings import MEDIA_FOLDER
+from app.settings import (
+    HOUSING_CACHE_BYTES,
+    LIKED_IDS_CACHE_USERS,
+    MAX_IMAGE_BYTES,
+)
 from core.models import (
+    BaseMixin,
     Chat,
     User,
     HousingCategory,
@@ -19,39 +64,373 @@ from core.models import (
     HousingComfort,
     HousingPricing,
     HousingImage,
+    HousingCalendar,
+    HousingNights,
+    HousingRating,
+    HousingReviewRating,
+    HousingRequest,
+    HousingHistory,
+    HousingVersion,
+    LikedHousing,
     Characteristic,
     Rule,
     HousingRule,
     CharacteristicType,
+    Feature,
+    ListingCard,
+    ReferenceVersion,
+    ReviewCategory,
+)
+from core.backends import StoredFile
+from core.cache import CachedDocument, DocumentCache, IdSetCache, ReferenceCache
+from core.images import (
+    IMAGE_ERRORS,
+    IMAGE_VARIANTS,
+    derived_key,
+    image_key,
+    image_urls,
+    image_urls_sql,
+    is_image,
+    variant_key,
+)
+from core.nights import MAX_NIGHTS, Nights
+from core.pricing import PRICING_FIELDS, quote, quotes_as_dicts
+from core.serializers import get_serializer, json_object_sql
+from core import storage
+from core.storage import (
+    content_file_name,
+    file_extension,
+    image_derivatives,
+    media_key,
+    release_files,
 )
 from core.schemas import (
     HouseCreate,
     HouseChange,
+    OfferFilters,
+    HousingPricingChange,
+    NightsChange,
+    RequestCreate,
 )
 
 
-def get_pagination_data(db: Session, page: int = 0, limit: int = 10) -> Any:
-    data = (
-        db.query(Housing, HousingImage, HousingCategory, HousingType)
-        .filter(
-            Housing.id == HousingImage.housing_id,
-            HousingCategory.id == Housing.category_id,
-            HousingType.id == Housing.type_id,
-            HousingImage.is_main == True,
+card_serializer = get_serializer(ListingCard)
+
+
+def card_as_dict(card: ListingCard) -> dict:
+    result = card_serializer(card)
+    result["main_image_urls"] = image_urls("housings", card.main_image)
+    return result
+
+
+def get_offers_query(db: Session) -> Query:
+    # listing_card has a row per housing with a main image
+    return db.query(ListingCard)
+
+
+CHARACTERISTIC_FILTERS = ("guests", "bedrooms", "beds", "baths")
+
+
+def offers_tsquery(q: str) -> Any:
+    return func.websearch_to_tsquery("english", q)
+
+
+def filter_offers(query: Query, filters: OfferFilters, skip: tuple = ()) -> Query:
+    """
+    :param skip: names of filters which must not be applied (used by facets)
+    """
+    if filters.q:
+        query = query.filter(
+            Housing.id == ListingCard.id,
+            Housing.search_vector.op("@@")(offers_tsquery(filters.q)),
+        )
+    if filters.category_id is not None and "category_id" not in skip:
+        query = query.filter(ListingCard.category_id == filters.category_id)
+    if filters.type_id is not None and "type_id" not in skip:
+        query = query.filter(ListingCard.type_id == filters.type_id)
+
+    if filters.price_min is not None:
+        query = query.filter(ListingCard.per_night >= filters.price_min)
+    if filters.price_max is not None:
+        query = query.filter(ListingCard.per_night <= filters.price_max)
+
+    if filters.check_in or filters.check_out:
+        query = filter_available(query, filters.check_in, filters.check_out)
+
+    for name in CHARACTERISTIC_FILTERS:
+        amount = getattr(filters, name)
+        if amount is not None:
+            query = query.filter(getattr(ListingCard, name) >= amount)
+    return query
+
+
+def filter_available(
+    query: Query, check_in: Union[date, None], check_out: Union[date, None]
+) -> Query:
+    """
+    Keeps housings whose calendar covers [check_in, check_out), which have no
+    accepted request or stay overlapping it and whose host blocked none of
+    its nights. Range operators are served by the gist indexes on `during`.
+    """
+    if not check_in or not check_out or check_out <= check_in:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="check_in and check_out are required and check_out must be "
+            "after check_in",
+        )
+    nights = (check_out - check_in).days
+    during = func.tsrange(
+        datetime.combine(check_in, time()),
+        datetime.combine(check_out, time()),
+        "[)",
+        type_=TSRANGE,
+    )
+
+    # nights of the stay stored in housing_nights, as offsets from its start
+    stored = (
+        func.generate_series(
+            func.greatest(check_in - HousingNights.start, 0),
+            func.least(
+                check_out - HousingNights.start, func.cardinality(HousingNights.prices)
+            )
+            - 1,
+        )
+        .table_valued("night")
+        .render_derived()
+    )
+    night = stored.c.night
+    return query.filter(
+        exists().where(
+            and_(
+                HousingCalendar.housing_id == ListingCard.id,
+                HousingCalendar.during.contains(during),
+                HousingCalendar.min_nights <= nights,
+                HousingCalendar.max_nights >= nights,
+            )
+        ),
+        ~exists().where(
+            and_(
+                HousingRequest.housing_id == ListingCard.id,
+                HousingRequest.accepted == True,
+                HousingRequest.during.overlaps(during),
+            )
+        ),
+        ~exists().where(
+            and_(
+                HousingHistory.housing_id == ListingCard.id,
+                HousingHistory.during.overlaps(during),
+            )
+        ),
+        # blocked bits are most significant first, get_bit counts from the
+        # least significant bit of each byte
+        ~select(HousingNights.id)
+        .join_from(HousingNights, stored, true())
+        .where(
+            HousingNights.housing_id == ListingCard.id,
+            func.get_bit(HousingNights.blocked, night / 8 * 8 + 7 - night % 8) == 1,
+        )
+        .exists(),
+    )
+
+
+def get_offer_facets(db: Session, filters: OfferFilters) -> dict:
+    """
+    Counts offers per category and per type. Each facet ignores its own filter,
+    so the client can see how many offers the other categories/types have.
+    """
+    query = (
+        get_offers_query(db)
+        .with_entities(
+            ListingCard.category_id,
+            ListingCard.category_name,
+            ListingCard.type_id,
+            ListingCard.type_name,
+            func.count(),
+        )
+        .group_by(
+            ListingCard.category_id,
+            ListingCard.category_name,
+            ListingCard.type_id,
+            ListingCard.type_name,
         )
-        .offset(page)
-        .limit(limit)
-        .all()
     )
-    new_list = []
-    for query in data:
-        housing = query.Housing.as_dict(
-            extra_fields=["characteristics", "category", "pricing", "type"]
+    data = filter_offers(query, filters, skip=("category_id", "type_id")).all()
+
+    categories: Dict[int, dict] = {}
+    types: Dict[int, dict] = {}
+    for category_id, category_name, type_id, type_name, count in data:
+        category = categories.setdefault(
+            category_id, {"id": category_id, "name": category_name, "count": 0}
+        )
+        type_ = types.setdefault(
+            type_id, {"id": type_id, "name": type_name, "count": 0}
+        )
+        if filters.type_id is None or filters.type_id == type_id:
+            category["count"] += count
+        if filters.category_id is None or filters.category_id == category_id:
+            type_["count"] += count
+
+    return {"categories": list(categories.values()), "types": list(types.values())}
+
+
+# most offers of a page of /offers and /offers/search
+OFFERS_LIMIT = 1000
+
+
+def get_pagination_data(
+    db: Session,
+    page: int = 0,
+    limit: int = 10,
+    filters: Union[OfferFilters, None] = None,
+) -> Any:
+    query = get_offers_query(db)
+    if filters:
+        query = filter_offers(query, filters)
+    return [card_as_dict(card) for card in query.offset(page).limit(limit)]
+
+
+EXPORT_BATCH_SIZE = 500
+
+
+def export_offers_(
+    db: Session,
+    updated_since: Union[datetime, None] = None,
+    filters: Union[OfferFilters, None] = None,
+) -> Iterator[dict]:
+    """
+    Every offer in the shape of get_pagination_data, read through a server
+    side cursor EXPORT_BATCH_SIZE rows at a time. Offers are ordered by
+    (updated_at, id), so the updated_at of the last one is the updated_since
+    of the next incremental export.
+    """
+    # the query is built before iterating, so invalid filters fail the request
+    # instead of the stream
+    query = get_offers_query(db)
+    if filters:
+        query = filter_offers(query, filters)
+    if updated_since:
+        query = query.filter(ListingCard.updated_at >= updated_since)
+    query = query.order_by(ListingCard.updated_at, ListingCard.id)
+
+    return map(card_as_dict, query.yield_per(EXPORT_BATCH_SIZE))
+
+
+class OfferSort(NamedTuple):
+    column: Any
+    descending: bool
+    parse: Callable[[Any], Any]
+
+
+# every sort is backed by an index of listing_card on (column, id)
+OFFER_SORTS: Dict[str, OfferSort] = {
+    "newest": OfferSort(ListingCard.created_at, True, datetime.fromisoformat),
+    "price": OfferSort(ListingCard.per_night, False, int),
+    "rating": OfferSort(ListingCard.rating, True, float),
+}
+
+
+def encode_cursor(sort: str, value: Any, housing_id: int) -> str:
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, housing_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str, sorts: Dict[str, OfferSort]) -> tuple:
+    try:
+        sort, value, housing_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return sort, sorts[sort].parse(value), int(housing_id)
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
         )
-        housing["main_image"] = query.HousingImage.as_dict()
-        new_list.append(housing)
 
-    return new_list
+
+def get_keyset_pagination_data(
+    db: Session,
+    after: str = "",
+    limit: int = 10,
+    sort: str = "newest",
+    filters: Union[OfferFilters, None] = None,
+    facets: bool = False,
+) -> dict:
+    """
+    :param after: next_cursor of the previous page, empty for the first page
+    :param facets: also count offers per category and type
+    :return: {"offers": [...], "next_cursor": str or None, "facets": dict}
+    """
+    sorts = OFFER_SORTS
+    if filters and filters.q:
+        # ts_rank_cd is a real, which compares unequal to the float8 of its
+        # cursor; ordered and compared as a float8, ties page as they should
+        rank = cast(
+            func.ts_rank_cd(Housing.search_vector, offers_tsquery(filters.q)),
+            Float(53),
+        )
+        sorts = {**OFFER_SORTS, "relevance": OfferSort(rank, True, float)}
+
+    if after:
+        sort, value, housing_id = decode_cursor(after, sorts)
+    if sort not in sorts:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown sort, available: {', '.join(sorts)}",
+        )
+    offer_sort = sorts[sort]
+
+    query = get_offers_query(db).add_columns(offer_sort.column.label("sort_key"))
+    if filters:
+        query = filter_offers(query, filters)
+    # offers without a price can't be placed by price
+    query = query.filter(offer_sort.column.isnot(None))
+
+    key: Any = tuple_(offer_sort.column, ListingCard.id)
+    if after:
+        bound: Any = tuple_(value, housing_id)
+        query = query.filter(key < bound if offer_sort.descending else key > bound)
+    if offer_sort.descending:
+        query = query.order_by(offer_sort.column.desc(), ListingCard.id.desc())
+    else:
+        query = query.order_by(offer_sort.column, ListingCard.id)
+
+    data = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(data) > limit:
+        data = data[:limit]
+        next_cursor = encode_cursor(sort, data[-1].sort_key, data[-1].ListingCard.id)
+
+    result: dict = {
+        "offers": [card_as_dict(row.ListingCard) for row in data],
+        "next_cursor": next_cursor,
+    }
+    if facets:
+        result["facets"] = get_offer_facets(db, filters or OfferFilters())
+    return result
+
+
+liked_housing_ids = IdSetCache(LIKED_IDS_CACHE_USERS)
+
+
+def get_liked_housing_ids_(user_id: int, db: Session) -> FrozenSet[int]:
+    def load() -> Iterable[int]:
+        query = db.query(LikedHousing.housing_id).filter(
+            LikedHousing.user_id == user_id
+        )
+        return (housing_id for housing_id, in query)
+
+    return liked_housing_ids.get(user_id, load)
+
+
+def mark_liked(offers: List[dict], user: Union[User, None], db: Session) -> None:
+    """
+    Sets "liked" of the offers for the user of the request, offers shown to
+    anonymous users are left as they are
+    """
+    if user is None:
+        return
+    liked = get_liked_housing_ids_(user.id, db)
+    for offer in offers:
+        offer["liked"] = offer["id"] in liked
 
 
 def get_chat_short_(user_id: int, chat_id: int, db: Session) -> Any:
@@ -106,10 +485,113 @@ def get_housing_by_user(
     return housing
 
 
-async def save_image(file_path: str, image: UploadFile) -> None:
-    contents = await image.read()
-    with open(file_path, "wb") as file:
-        file.write(contents)
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+
+class SavedFile(NamedTuple):
+    size: int
+    sha256: str
+
+
+def hash_upload(source: BinaryIO, max_bytes: int) -> SavedFile:
+    """
+    Hashes `source` UPLOAD_CHUNK_BYTES at a time and rewinds it for storing
+
+    :raises HTTPException: 413 when source is larger than max_bytes
+    """
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(partial(source.read, UPLOAD_CHUNK_BYTES), b""):
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Image is larger than {max_bytes} bytes",
+            )
+        digest.update(chunk)
+    source.seek(0)
+    return SavedFile(size, digest.hexdigest())
+
+
+class ReceivedImage(NamedTuple):
+    file: BinaryIO
+    file_name: str
+
+
+async def receive_image(image: UploadFile) -> ReceivedImage:
+    """
+    :return: the upload and the content addressed file name which
+     store_image stores it under
+    """
+    # hashing blocks on the spooled upload, so it runs in the threadpool
+    saved: SavedFile = await run_in_threadpool(hash_upload, image.file, MAX_IMAGE_BYTES)
+    if not await run_in_threadpool(is_image, image.file):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Image can't be decoded",
+        )
+    extension = file_extension(image.filename or "")
+    # a SpooledTemporaryFile opened in binary mode
+    file = typing.cast(BinaryIO, image.file)
+    return ReceivedImage(file, content_file_name(saved.sha256, extension))
+
+
+def store_file(key: str, source: BinaryIO) -> None:
+    storage.media_storage.put(key, source)
+    # the last variant is stored last
+    if storage.media_storage.stat(derived_key(key, IMAGE_VARIANTS[-1])) is None:
+        image_derivatives.submit(key)
+
+
+async def store_image(kind: str, received: ReceivedImage, db: Session) -> None:
+    """
+    Stores a received image and commits the transaction of db, which
+    references it. The reference is flushed first, which locks its media_file
+    row, so the file can't be removed by a concurrent release before the
+    commit; nothing is committed when the file can't be stored.
+    """
+    db.flush()
+    try:
+        await run_in_threadpool(
+            store_file, media_key(kind, received.file_name), received.file
+        )
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
+
+async def get_image_derivative_(
+    kind: str, file_name: str, variant: str
+) -> Union[Tuple[str, StoredFile], None]:
+    """
+    :return: storage key of a derivative of an uploaded image, which is made
+     now if it's missing, and its size; None if there is no such image or it
+     can't be decoded
+    """
+    key = variant_key(kind, file_name, variant)
+    if key is None:
+        return None
+    stored = await run_in_threadpool(storage.media_storage.stat, key)
+    if stored is None:
+        image = media_key(kind, file_name)
+        if await run_in_threadpool(storage.media_storage.stat, image) is None:
+            return None
+        try:
+            await image_derivatives.run(image)
+        except IMAGE_ERRORS:
+            # e.g. uploaded before uploads were checked
+            return None
+        stored = await run_in_threadpool(storage.media_storage.stat, key)
+    return None if stored is None else (key, stored)
+
+
+def get_media_file_(kind: str, file_name: str) -> Union[Tuple[str, StoredFile], None]:
+    key = image_key(kind, file_name)
+    if key is None:
+        return None
+    stored = storage.media_storage.stat(key)
+    return None if stored is None else (key, stored)
 
 
 def replace_main_housing_image(
@@ -123,10 +605,10 @@ def replace_main_housing_image(
     if not main_image:
         return None
     main_image.is_main = None
-    db.commit()
+    db.flush()
     housing_image.is_main = True
     db.add(housing_image)
-    db.commit()
+    db.flush()
     return housing_image
 
 
@@ -139,23 +621,20 @@ async def create_housing_image_(
     ):
         is_main = True
 
-    file_name = f'{uuid.uuid4()}.{image.filename.split(".")[-1]}'
+    received = await receive_image(image)
+
     housing_image: HousingImage = HousingImage(
-        housing_id=housing_id, is_main=is_main, file_name=file_name
+        housing_id=housing_id, is_main=is_main, file_name=received.file_name
     )
     db.add(housing_image)
 
     try:
-        db.commit()
+        db.flush()
     # image with is_main = True already exists, so move is_main parameter ...
     except IntegrityError:
         db.rollback()
         replace_main_housing_image(housing_image, housing_id, db)
-
-    file_path = f"{MEDIA_FOLDER}/housings/{housing_image.file_name}"
-
-    await save_image(file_path, image)
-
+    await store_image("housings", received, db)
     return housing_image
 
 
@@ -169,14 +648,10 @@ def delete_housing_image_(
     )
     if not housing_image:
         return None
-    file_path = f"{MEDIA_FOLDER}/housings/{housing_image.file_name}"
-    try:
-        os.remove(file_path)
-    except FileNotFoundError:
-        print(FileNotFoundError)
 
     db.delete(housing_image)
     db.commit()
+    release_files("housings", [housing_image.file_name], db)
     try:
         if housing_image.is_main:
             db.query(HousingImage).filter(
@@ -200,7 +675,9 @@ def set_main_housing_image_(
     if not housing_image:
         return None
 
-    return replace_main_housing_image(housing_image, housing_id, db)
+    main_image = replace_main_housing_image(housing_image, housing_id, db)
+    db.commit()
+    return main_image
 
 
 def create_housing(
@@ -239,35 +716,48 @@ def create_characteristics(
 def delete_housing_(housing_id: int, db: Session) -> Housing:
     query = db.query(Housing).filter(Housing.id == housing_id)
     housing: Housing = query.first()
+    file_names = db.query(HousingImage.file_name).filter(
+        HousingImage.housing_id == housing_id
+    )
+    released = [file_name for file_name, in file_names]
     query.delete()
     db.commit()
+    # the images were deleted by the cascade
+    release_files("housings", released, db)
     return housing
 
 
 def change_characteristics(
     characteristics_list: list, housing_id: int, db: Session
 ) -> None:
-    for characteristic_dict in characteristics_list:
-        characteristic: Characteristic = (
-            db.query(Characteristic)
-            .filter(
-                Characteristic.characteristic_type_id
-                == characteristic_dict.characteristic_id
-            )
-            .first()
-        )
-        if characteristic:
-            characteristic.amount = characteristic_dict.amount
-        else:
-            characteristic_new: Characteristic = Characteristic(
-                amount=characteristic_dict.amount,
-                housing_id=housing_id,
-                characteristic_type_id=characteristic_dict.characteristic_id,
-            )
-            db.add(characteristic_new)
-        db.commit()
-        if characteristic:
-            db.refresh(characteristic)
+    """
+    Upserts the characteristics of the housing with one statement, without
+    committing
+    """
+    # the last amount wins, a row can't be upserted twice by one statement
+    amounts = {
+        characteristic.characteristic_id: characteristic.amount
+        for characteristic in characteristics_list
+    }
+    statement = pg_insert(Characteristic).values(
+        [
+            {
+                "amount": amount,
+                "housing_id": housing_id,
+                "characteristic_type_id": characteristic_type_id,
+            }
+            for characteristic_type_id, amount in amounts.items()
+        ]
+    )
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[
+                Characteristic.housing_id,
+                Characteristic.characteristic_type_id,
+            ],
+            set_={"amount": statement.excluded.amount, "updated_at": func.now()},
+        )
+    )
 
 
 def change_housing_pricing(
@@ -278,7 +768,6 @@ def change_housing_pricing(
     )
     housing_pricing.per_night = per_night
     db.add(housing_pricing)
-    db.commit()
     return housing_pricing
 
 
@@ -325,45 +814,525 @@ def create_housing_pricing(
     return housing_pricing
 
 
-def get_housing_(housing_id: int, db: Session) -> dict:
-    housing: Housing = db.query(Housing).filter(Housing.id == housing_id).first()
-    if not housing:
-        return {"detail": "Housing doesn't exists"}
-    characteristics = (
-        db.query(Characteristic).filter(Characteristic.housing_id == housing_id).all()
-    )
-    characteristics = [
-        i.as_dict(extra_fields=["characteristic_type"]) for i in characteristics
-    ]
+BULK_HOUSING_LIMIT = 1000
+
+
+def create_housings_bulk_(
+    house_schemes: List[HouseCreate], user: User, db: Session
+) -> List[int]:
+    """
+    Creates the housings with their characteristics and pricing in one
+    transaction, with one multi-row INSERT per table.
+
+    :return: ids of the new housings, in the order of house_schemes
+    """
+    if not 0 < len(house_schemes) <= BULK_HOUSING_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"From 1 to {BULK_HOUSING_LIMIT} housings can be created at once",
+        )
 
-    rules = (
-        db.query(HousingRule, Rule)
-        .filter(HousingRule.housing_id == housing_id, HousingRule.id == Rule.id)
+    # the order of RETURNING isn't the one of VALUES, so the ids which tie
+    # the characteristics and pricing to their housing are drawn beforehand
+    housing_ids: List[int] = (
+        db.execute(
+            select(
+                func.nextval(func.pg_get_serial_sequence(Housing.__tablename__, "id"))
+            ).select_from(func.generate_series(1, len(house_schemes)))
+        )
+        .scalars()
         .all()
     )
-    rules = [i.Rule.as_dict(extend=["updated_at", "created_at"]) for i in rules]
+    try:
+        db.execute(
+            insert(Housing).values(
+                [
+                    {
+                        "id": housing_id,
+                        "name": house_scheme.name,
+                        "address": house_scheme.address,
+                        "user_id": user.id,
+                        "description": house_scheme.description,
+                        "category_id": house_scheme.category_id,
+                        "type_id": house_scheme.type_id,
+                    }
+                    for housing_id, house_scheme in zip(housing_ids, house_schemes)
+                ]
+            )
+        )
+
+        characteristics = [
+            {
+                "amount": characteristic.amount,
+                "housing_id": housing_id,
+                "characteristic_type_id": characteristic.characteristic_id,
+            }
+            for housing_id, house_scheme in zip(housing_ids, house_schemes)
+            for characteristic in house_scheme.characteristics
+        ]
+        if characteristics:
+            db.execute(insert(Characteristic).values(characteristics))
 
-    comforts = (
-        db.query(HousingComfort, Comfort, ComfortCategory)
-        .filter(
-            HousingComfort.housing_id == housing_id,
-            Comfort.category_id == ComfortCategory.id,
-            HousingComfort.comfort_id == Comfort.id,
+        db.execute(
+            insert(HousingPricing).values(
+                [
+                    {
+                        "per_night": house_scheme.per_night,
+                        "cleaning": 0,
+                        "service": 0,
+                        "discount_per_week": 0,
+                        "discount_per_month": 0,
+                        "housing_id": housing_id,
+                    }
+                    for housing_id, house_scheme in zip(housing_ids, house_schemes)
+                ]
+            )
         )
-        .all()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unknown category, type or characteristic, or a characteristic "
+            "repeated in one housing. No housings were created",
+        )
+    return housing_ids
+
+
+pricing_serializer = get_serializer(HousingPricing)
+
+
+def change_housings_pricing_(
+    pricing_change: HousingPricingChange, user: User, db: Session
+) -> List[dict]:
+    """
+    Applies new values and percent adjustments to the pricing of the user's
+    housings with one UPDATE ... FROM (VALUES ...) RETURNING. Nothing is
+    changed unless the user owns every housing.
+
+    :return: the changed pricing rows
+    """
+    changes: Dict[int, Dict[str, Any]] = {}
+
+    def get_change(housing_id: int) -> Dict[str, Any]:
+        return changes.setdefault(
+            housing_id,
+            {
+                **dict.fromkeys(PRICING_FIELDS),
+                **{f"{name}_factor": 1.0 for name in PRICING_FIELDS},
+            },
+        )
+
+    for price in pricing_change.prices:
+        change = get_change(price.housing_id)
+        for name in PRICING_FIELDS:
+            if getattr(price, name) is not None:
+                change[name] = getattr(price, name)
+    for adjustment in pricing_change.adjustments:
+        for housing_id in adjustment.housing_ids:
+            change = get_change(housing_id)
+            for name in PRICING_FIELDS:
+                if getattr(adjustment, name) is not None:
+                    change[f"{name}_factor"] *= 1 + getattr(adjustment, name) / 100
+
+    if not 0 < len(changes) <= BULK_HOUSING_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"From 1 to {BULK_HOUSING_LIMIT} housings can be repriced at once",
+        )
+
+    columns: List[Any] = [
+        column("housing_id", Integer),
+        *(column(name, Integer) for name in PRICING_FIELDS),
+        *(column(f"{name}_factor", Float) for name in PRICING_FIELDS),
+    ]
+    change_values = values(*columns, name="change").data(
+        [
+            (housing_id, *(change[column.name] for column in columns[1:]))
+            for housing_id, change in changes.items()
+        ]
     )
+    statement = (
+        update(HousingPricing)
+        .where(
+            HousingPricing.housing_id == change_values.c.housing_id,
+            Housing.id == HousingPricing.housing_id,
+            Housing.user_id == user.id,
+        )
+        .values(
+            {
+                # a column of nulls only is typed text by postgres
+                name: func.round(
+                    func.coalesce(
+                        cast(change_values.c[name], Integer),
+                        getattr(HousingPricing, name),
+                    )
+                    * change_values.c[f"{name}_factor"]
+                )
+                for name in PRICING_FIELDS
+            },
+        )
+        .values(updated_at=func.now())
+        .returning(*HousingPricing.__table__.columns)
+        .execution_options(synchronize_session=False)
+    )
+
+    try:
+        rows = db.execute(statement).mappings().all()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Prices can't be negative and discounts must be from 0 to 100",
+        )
+    not_owned = set(changes) - {row["housing_id"] for row in rows}
+    if not_owned:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Permissions denied. User with id = {user.id} is not owner or "
+            f"housings with ids = {sorted(not_owned)} don't exist",
+        )
+    db.commit()
+    return [pricing_serializer.from_mapping(row) for row in rows]
+
+
+QUOTE_LIMIT = 1000
+
+
+def get_quotes_(
+    db: Session,
+    check_in: date,
+    check_out: date,
+    housing_ids: Union[List[int], None] = None,
+) -> List[dict]:
+    """
+    Prices a stay from check_in to check_out at the given housings, or at
+    every priced housing up to QUOTE_LIMIT.
+
+    :return: subtotal, discount, cleaning, service and total per housing,
+     ordered by housing id
+    """
+    if check_out <= check_in:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="check_out must be after check_in",
+        )
+    if housing_ids is not None and len(housing_ids) > QUOTE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Up to {QUOTE_LIMIT} housings can be quoted at once",
+        )
 
-    comforts = [
-        i.Comfort.as_dict(extend=["updated_at", "created_at"]) for i in comforts
+    query = db.query(
+        HousingPricing.housing_id,
+        *(getattr(HousingPricing, name) for name in PRICING_FIELDS),
+        HousingNights.start,
+        HousingNights.prices,
+        HousingNights.blocked,
+    ).outerjoin(HousingNights, HousingNights.housing_id == HousingPricing.housing_id)
+    if housing_ids is not None:
+        query = query.filter(HousingPricing.housing_id.in_(housing_ids))
+    rows = query.order_by(HousingPricing.housing_id).limit(QUOTE_LIMIT).all()
+
+    nights = (check_out - check_in).days
+    pricing = np.array(
+        [row[: len(PRICING_FIELDS) + 1] for row in rows], dtype=np.int64
+    ).reshape(-1, len(PRICING_FIELDS) + 1)
+    night_prices = stored_night_prices(rows, check_in, check_out)
+    return quotes_as_dicts(
+        pricing[:, 0].tolist(), nights, quote(pricing[:, 1:], nights, night_prices)
+    )
+
+
+def stored_night_prices(
+    rows: List[Any], check_in: date, check_out: date
+) -> Union[np.ndarray, None]:
+    """
+    :param rows: with the start, prices and blocked of their HousingNights,
+     None when there is no row
+    :return: (rows, n) matrix of the prices of the n nights of the stay which
+     some row stores, nan for the per_night of the housing; None if no row
+     stores any
+    """
+    stored = [
+        (index, Nights.unpack(row.start, row.prices, row.blocked))
+        for index, row in enumerate(rows)
+        if row.start is not None
     ]
+    if not stored:
+        return None
+    # columns only span stored nights, however long the stay
+    start = max(check_in, min(nights.start for _, nights in stored))
+    end = min(check_out, max(nights.end for _, nights in stored))
+    if end <= start:
+        return None
+    night_prices = np.full((len(rows), (end - start).days), np.nan)
+    for index, nights in stored:
+        night_prices[index] = nights.window(start, end).prices
+    return night_prices
+
 
-    housing_dict = housing.as_dict(
-        extra_fields=["user", "housing_images", "type", "calendar", "pricing"]
+def get_nights_(
+    housing_id: int, start: date, end: date, db: Session
+) -> Union[dict, None]:
+    """
+    :return: price and availability of every night from start to end (end
+     excluded), read with one row
+    """
+    if not 0 < (end - start).days <= MAX_NIGHTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"end must be after start and at most {MAX_NIGHTS} nights later",
+        )
+    row = (
+        db.query(
+            HousingPricing.per_night,
+            HousingNights.start,
+            HousingNights.prices,
+            HousingNights.blocked,
+        )
+        .outerjoin(HousingNights, HousingNights.housing_id == HousingPricing.housing_id)
+        .filter(HousingPricing.housing_id == housing_id)
+        .first()
     )
-    housing_dict["characteristics"] = characteristics
-    housing_dict["rules"] = rules
-    housing_dict["comforts"] = comforts
-    return housing_dict
+    if row is None:
+        return None
+
+    if row.start is None:
+        nights = Nights.empty(start)
+    else:
+        nights = Nights.unpack(row.start, row.prices, row.blocked)
+    window = nights.window(start, end)
+    prices = np.where(np.isnan(window.prices), row.per_night, window.prices)
+    return {
+        "housing_id": housing_id,
+        "start": start,
+        "end": end,
+        "prices": prices.astype(np.int64).tolist(),
+        "available": (~window.blocked).tolist(),
+    }
+
+
+def change_nights_(
+    housing_id: int, nights_change: NightsChange, db: Session
+) -> Union[dict, None]:
+    """
+    Sets prices and availability of spans of nights. Nights before today are
+    dropped from the row, so it holds at most MAX_NIGHTS nights.
+    """
+    today = date.today()
+    last_day = today + timedelta(days=MAX_NIGHTS)
+    spans = nights_change.spans
+    if not spans or not all(
+        today <= span.start < span.end <= last_day for span in spans
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Spans must be between today and {last_day}, "
+            "with end after start",
+        )
+
+    db.execute(
+        pg_insert(HousingNights)
+        .values(housing_id=housing_id, start=today, prices=[], blocked=b"")
+        .on_conflict_do_nothing(index_elements=[HousingNights.housing_id])
+    )
+    row: HousingNights = (
+        db.query(HousingNights)
+        .filter(HousingNights.housing_id == housing_id)
+        .with_for_update()
+        .one()
+    )
+    nights = Nights.unpack(row.start, row.prices, row.blocked)
+    nights = nights.window(today, max(nights.end, *(span.end for span in spans)))
+    for span in spans:
+        low, high = (span.start - today).days, (span.end - today).days
+        if span.reset_price:
+            nights.prices[low:high] = np.nan
+        if span.price is not None:
+            nights.prices[low:high] = span.price
+        if span.available is not None:
+            nights.blocked[low:high] = not span.available
+    row.start, row.prices, row.blocked = nights.pack()
+    db.commit()
+
+    return get_nights_(
+        housing_id,
+        min(span.start for span in spans),
+        max(span.end for span in spans),
+        db,
+    )
+
+
+request_serializer = get_serializer(HousingRequest)
+
+
+def stay_range(check_in: date, check_out: date) -> DateTimeRange:
+    return DateTimeRange(
+        datetime.combine(check_in, time()), datetime.combine(check_out, time()), "[)"
+    )
+
+
+def create_request_(request_scheme: RequestCreate, user: User, db: Session) -> dict:
+    if request_scheme.check_out <= request_scheme.check_in:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="check_out must be after check_in",
+        )
+    housing_request = HousingRequest(
+        housing_id=request_scheme.housing_id,
+        user_id=user.id,
+        during=stay_range(request_scheme.check_in, request_scheme.check_out),
+        number_of_guests=request_scheme.number_of_guests,
+        message=request_scheme.message,
+    )
+    db.add(housing_request)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Housing doesn't exists or number_of_guests isn't from 1 to 9",
+        )
+    return request_serializer(housing_request)
+
+
+def get_requests_(user: User, db: Session) -> List[dict]:
+    """
+    :return: requests made by the user and requests to the user's housings
+    """
+    query = (
+        db.query(HousingRequest)
+        .join(Housing, Housing.id == HousingRequest.housing_id)
+        .filter(or_(HousingRequest.user_id == user.id, Housing.user_id == user.id))
+        .order_by(HousingRequest.id)
+    )
+    return request_serializer.many(query)
+
+
+def accept_request_(request_id: int, user: User, db: Session) -> dict:
+    """
+    Accepts a request to the user's housing. Overlapping accepted requests
+    are rejected by the exclusion constraint on request, so concurrent
+    accepts need no locks: exactly one of the overlapping ones commits.
+    """
+    statement = (
+        update(HousingRequest)
+        .where(
+            HousingRequest.id == request_id,
+            Housing.id == HousingRequest.housing_id,
+            Housing.user_id == user.id,
+        )
+        .values(accepted=True)
+        .returning(*HousingRequest.__table__.columns)
+        .execution_options(synchronize_session=False)
+    )
+    try:
+        row = db.execute(statement).mappings().first()
+        db.commit()
+    except IntegrityError as error:
+        db.rollback()
+        if getattr(error.orig, "pgcode", None) == errorcodes.EXCLUSION_VIOLATION:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Housing is already booked for these dates",
+            )
+        raise
+
+    if row is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Permissions denied. User with id = {user.id} is not owner or "
+            f"request with id = {request_id} doesn't exists",
+        )
+    return request_serializer.from_mapping(row)
+
+
+def json_agg_sql(json_sql: str, from_sql: str) -> str:
+    return f"coalesce((select json_agg({json_sql}) {from_sql}), '[]'::json)"
+
+
+characteristic_json_sql = json_object_sql(
+    Characteristic,
+    "ch",
+    extra_fields={"characteristic_type": json_object_sql(CharacteristicType, "ct")},
+)
+HOUSING_DOCUMENT_FIELDS = {
+    "user": f"""(select {json_object_sql(User, "u")}
+        from "user" u where u.id = h.user_id)""",
+    "housing_images": json_agg_sql(
+        f"""{json_object_sql(
+            HousingImage,
+            "i",
+            extra_fields={"urls": image_urls_sql("housings", "i.file_name")},
+        )} order by i.id""",
+        "from housing_image i where i.housing_id = h.id",
+    ),
+    "type": f"""(select {json_object_sql(HousingType, "t")}
+        from housing_type t where t.id = h.type_id)""",
+    "calendar": f"""(select {json_object_sql(HousingCalendar, "c")}
+        from housing_calendar c where c.housing_id = h.id)""",
+    "pricing": f"""(select {json_object_sql(HousingPricing, "p")}
+        from housing_pricing p where p.housing_id = h.id)""",
+    "characteristics": json_agg_sql(
+        f"{characteristic_json_sql} order by ch.id",
+        """from characteristic ch
+        join characteristic_type ct on ct.id = ch.characteristic_type_id
+        where ch.housing_id = h.id""",
+    ),
+    "rules": json_agg_sql(
+        f"""{json_object_sql(Rule, "r", extend=["created_at", "updated_at"])}
+        order by r.id""",
+        """from housing_rule hr join rule r on r.id = hr.rule_id
+        where hr.housing_id = h.id""",
+    ),
+    "comforts": json_agg_sql(
+        f"""{json_object_sql(Comfort, "co", extend=["created_at", "updated_at"])}
+        order by co.id""",
+        """from housing_comfort hc join comfort co on co.id = hc.comfort_id
+        where hc.housing_id = h.id""",
+    ),
+    "rating": f"""(select {json_object_sql(HousingRating, "hra")}
+        from housing_rating hra where hra.housing_id = h.id)""",
+    "review_ratings": json_agg_sql(
+        f"""{json_object_sql(HousingReviewRating, "rr")}
+        order by rr.review_category_id""",
+        "from housing_review_rating rr where rr.housing_id = h.id",
+    ),
+}
+HOUSING_DOCUMENT_SQL = text(
+    f"""
+    select {json_object_sql(Housing, "h", extra_fields=HOUSING_DOCUMENT_FIELDS)}::text,
+        v.version
+    from housing h join housing_version v on v.housing_id = h.id
+    where h.id = :housing_id
+    """
+)
+
+housing_cache = DocumentCache(HOUSING_CACHE_BYTES)
+
+
+def get_housing_json_(housing_id: int, db: Session) -> Union[CachedDocument, None]:
+    """
+    :return: the encoded housing document with user, images, type, calendar,
+     pricing, characteristics, rules, comforts and ratings, built by one SQL
+     statement and kept in housing_cache until its version changes
+    """
+
+    def load() -> Union[Tuple[int, bytes], None]:
+        row = db.execute(HOUSING_DOCUMENT_SQL, {"housing_id": housing_id}).first()
+        return (row[1], row[0].encode()) if row else None
+
+    version = (
+        db.query(HousingVersion.version)
+        .filter(HousingVersion.housing_id == housing_id)
+        .scalar()
+    )
+    if version is None:
+        return None
+    return housing_cache.get(housing_id, version, load)
 
 
 def create_housings_attrs_(db: Session) -> None:
@@ -398,13 +1367,28 @@ def create_housings_attrs_(db: Session) -> None:
     db.commit()
 
 
+REFERENCE_MODELS: Dict[str, Type[BaseMixin]] = {
+    "housing_types": HousingType,
+    "characteristic_types": CharacteristicType,
+    "housing_categories": HousingCategory,
+    "comfort_categories": ComfortCategory,
+    "comforts": Comfort,
+    "rules": Rule,
+    "features": Feature,
+    "review_categories": ReviewCategory,
+}
+
+
 def get_housing_fields_(db: Session) -> dict:
     return {
-        "housing_types": [obj.as_dict() for obj in db.query(HousingType).all()],
-        "characteristic_types": [
-            obj.as_dict() for obj in db.query(CharacteristicType).all()
-        ],
-        "housing_categories": [
-            obj.as_dict() for obj in db.query(HousingCategory).all()
-        ],
+        name: get_serializer(model).many(db.query(model).order_by(model.id))
+        for name, model in REFERENCE_MODELS.items()
     }
+
+
+def get_reference_version(db: Session) -> int:
+    version: int = db.query(ReferenceVersion.version).scalar()
+    return version
+
+
+housing_fields_cache = ReferenceCache(get_housing_fields_, get_reference_version)
@@ -0,0 +1,222 @@
+"""
+Content addressed layout of uploaded images: a file is stored once per kind,
+under the key <kind>/<aa>/<bb>/<sha256>.<extension> of media_storage, and its
+media_file row counts the housing_image and user rows which reference it.
+
+Files of the flat <uuid>.<extension> layout of older uploads are moved to it,
+and the files no row references any more are removed, with
+
+    python -m core.storage migrate
+    python -m core.storage collect
+
+collect removes the old files of migrate, so run it once the documents
+cached by the API processes have expired.
+"""
+import hashlib
+import sys
+from contextlib import contextmanager
+from typing import Any, Iterable, Iterator, List, Tuple, Union
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from app.settings import (
+    IMAGE_WORKERS,
+    MEDIA_FOLDER,
+    MEDIA_STORAGE,
+    Session as SessionMaker,
+)
+from core.backends import MediaStorage, make_storage
+from core.images import IMAGE_VARIANTS, DerivativePool, derived_key
+from core.models import HousingImage, MediaFile, User
+
+media_storage = make_storage(MEDIA_STORAGE, MEDIA_FOLDER)
+image_derivatives = DerivativePool(IMAGE_WORKERS, media_storage)
+# folders of two hex digits of the hash above every file, 65536 in total
+SHARD_LEVELS = 2
+# kind -> column with the file names of its images
+MEDIA_REFERENCES: Tuple[Tuple[str, Any], ...] = (
+    ("housings", HousingImage.file_name),
+    ("users", User.image),
+)
+
+
+@contextmanager
+def use_media_storage(storage: MediaStorage) -> Iterator[MediaStorage]:
+    """
+    Stores media and their derivatives in `storage` instead of media_storage
+    while in the block, e.g. in tests. Modules read media_storage of this
+    module, so they see the replacement.
+    """
+    global media_storage
+    previous = media_storage
+    media_storage = image_derivatives.storage = storage
+    try:
+        yield storage
+    finally:
+        media_storage = image_derivatives.storage = previous
+
+
+def media_key(kind: str, file_name: str) -> str:
+    return f"{kind}/{file_name}"
+
+
+def file_extension(file_name: str) -> str:
+    extension = file_name.rsplit(".", 1)[-1].lower()
+    return extension if extension.isalnum() else "bin"
+
+
+def content_file_name(sha256: str, extension: str) -> str:
+    shards = [sha256[level * 2 : level * 2 + 2] for level in range(SHARD_LEVELS)]
+    return "/".join((*shards, f"{sha256}.{extension}"))
+
+
+def hash_file(key: str) -> str:
+    digest = hashlib.sha256()
+    for chunk in media_storage.stream(key):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove_image(key: str) -> None:
+    # the uploaded file and every derivative of it
+    media_storage.delete(key)
+    for variant in IMAGE_VARIANTS:
+        media_storage.delete(derived_key(key, variant))
+
+
+def release_files(
+    kind: str, file_names: Iterable[Union[str, None]], db: Session
+) -> None:
+    """
+    Removes the files of references which a committed transaction deleted or
+    changed, when no row references them any more. Call it after committing:
+    a rolled back change still references its files. Their media_file rows
+    stay locked until the files are gone, so an upload of the same content
+    waits for that and stores the file again.
+    """
+    paths = [media_key(kind, file_name) for file_name in file_names if file_name]
+    if not paths:
+        return
+    released: List[str] = (
+        db.execute(
+            delete(MediaFile)
+            .where(MediaFile.path.in_(paths), MediaFile.reference_count <= 0)
+            .returning(MediaFile.path)
+            .execution_options(synchronize_session=False)
+        )
+        .scalars()
+        .all()
+    )
+    for path in released:
+        remove_image(path)
+    db.commit()
+
+
+def collect_files(db: Session, batch_size: int = 500) -> int:
+    """
+    Removes the files which no row references, e.g. the images of deleted
+    housings or the old files of migrate_files
+
+    :return: number of removed files
+    """
+    removed = 0
+    while True:
+        unreferenced = (
+            select(MediaFile.id)
+            .where(MediaFile.reference_count <= 0)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        paths: List[str] = (
+            db.execute(
+                delete(MediaFile)
+                .where(MediaFile.__table__.c.id.in_(unreferenced))
+                .returning(MediaFile.path)
+                .execution_options(synchronize_session=False)
+            )
+            .scalars()
+            .all()
+        )
+        for path in paths:
+            remove_image(path)
+        db.commit()
+        removed += len(paths)
+        if len(paths) < batch_size:
+            return removed
+
+
+def migrate_files(db: Session, batch_size: int = 500) -> Tuple[int, int]:
+    """
+    Rewrites the file names of the flat layout to content addressed ones, one
+    committed batch at a time. The new files are copies of the old ones, hard
+    links for local files, and the old ones are left for collect_files;
+    derivatives are copied along.
+
+    :return: numbers of migrated references and of references whose file is
+     missing, which are left as they are
+    """
+    migrated = missing = 0
+    for kind, column in MEDIA_REFERENCES:
+        model = column.class_
+        last_id = 0
+        while True:
+            rows = (
+                db.query(model)
+                .filter(
+                    model.id > last_id,
+                    column.isnot(None),
+                    column.notlike("%/%"),
+                )
+                .order_by(model.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            moves = []
+            for row in rows:
+                old_name = getattr(row, column.key)
+                old_key = media_key(kind, old_name)
+                if media_storage.stat(old_key) is None:
+                    missing += 1
+                    continue
+                new_name = content_file_name(
+                    hash_file(old_key), file_extension(old_name)
+                )
+                setattr(row, column.key, new_name)
+                moves.append((old_key, media_key(kind, new_name)))
+
+            # the new references lock their media_file rows before the files
+            # are copied, so a concurrent release can't remove them
+            db.flush()
+            for old_key, new_key in moves:
+                media_storage.copy(old_key, new_key)
+                for variant in IMAGE_VARIANTS:
+                    media_storage.copy(
+                        derived_key(old_key, variant), derived_key(new_key, variant)
+                    )
+            db.commit()
+            migrated += len(moves)
+    return migrated, missing
+
+
+def main(commands: list) -> None:
+    db = SessionMaker()
+    try:
+        for command in commands:
+            if command == "migrate":
+                migrated, missing = migrate_files(db)
+                print(f"migrated {migrated} files, {missing} missing")
+            elif command == "collect":
+                print(f"removed {collect_files(db)} files")
+            else:
+                raise SystemExit(f"unknown command {command}, use migrate or collect")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,10 +1,58 @@
+import hashlib
+import io
+import json
+import os
 import random
-from typing import Callable, Dict, Union
+import tempfile
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from operator import attrgetter, itemgetter
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Union
 
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
 from fastapi.testclient import TestClient
+from PIL import Image
+from psycopg2.extras import DateTimeRange
 from requests import Response  # type: ignore
 
+from sqlalchemy import event, text
+from sqlalchemy_utils import PhoneNumber
+from starlette.responses import JSONResponse
+
+from app.responses import ORJSONResponse
+from app.settings import Session, engine
 from auth.test_auth import auth_and_create_user, auth
+from core.benchmarks import legacy_as_dict, make_offer
+from core.cache import DocumentCache
+from core.backends import LocalStorage, MediaStorage, MemoryStorage, PackStorage
+from core.images import IMAGE_SIZES, IMAGE_VARIANTS, derived_key, image_urls
+from core.models import (
+    Housing,
+    HousingCalendar,
+    HousingImage,
+    HousingRequest,
+    MediaFile,
+    ReviewCategory,
+    ReviewGrade,
+    Rule,
+    User,
+)
+from core.serializers import serialize
+from core.storage import (
+    collect_files,
+    content_file_name,
+    image_derivatives,
+    migrate_files,
+    release_files,
+    use_media_storage,
+)
+from core.services import OFFERS_LIMIT, accept_request_, hash_upload
+from core.views import media_response
 from main import app
 
 client = TestClient(app)
@@ -107,32 +155,116 @@ def test_housing_fields() -> None:
     assert response.json() is not None
 
 
+def test_housing_fields_cache() -> None:
+    etag = client.get("/housing/fields/").headers["etag"]
+
+    # only the version is read
+    with count_queries() as statements:
+        response = client.get("/housing/fields/")
+        assert response.headers["etag"] == etag
+        response = client.get("/housing/fields/", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+    assert len(statements) == 2
+
+    db = Session()
+    rule = Rule(name="No parties")
+    db.add(rule)
+    db.commit()
+
+    response = client.get("/housing/fields/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert {"id": rule.id, "name": "No parties"}.items() <= response.json()["rules"][
+        -1
+    ].items()
+
+    # e.g. by another process
+    with engine.begin() as connection:
+        connection.execute(
+            text("update rule set name = 'No events' where id = :id"), {"id": rule.id}
+        )
+    assert client.get("/housing/fields/").json()["rules"][-1]["name"] == "No events"
+
+    db.query(Rule).filter(Rule.id == rule.id).delete()
+    db.commit()
+    db.close()
+
+    response = client.get("/housing/fields/")
+    assert response.headers["etag"] == etag
+
+
+def create_housing(headers: Any) -> int:
+    fields = client.get("/housing/fields/", headers=headers).json()
+
+    request_data = {
+        "name": f"test_{random.randint(10, 1000)}",
+        "address": f"test_{random.randint(10, 1000)}",
+        "description": f"test_{random.randint(10, 1000)}",
+        "type_id": random.choice(fields["housing_types"])["id"],
+        "category_id": random.choice(fields["housing_categories"])["id"],
+        "per_night": random.randint(10, 10000),
+        "characteristics": [],
+    }
+    for characteristic_type in fields["characteristic_types"]:
+        request_data["characteristics"].append(
+            {
+                "characteristic_id": characteristic_type["id"],
+                "amount": random.randint(0, 30),
+            }
+        )
+
+    response = client.post("/housing", headers=headers, json=request_data)
+    housing_id: int = response.json()
+    assert isinstance(housing_id, int)
+    return housing_id
+
+
+@auth
+def test_create_housings_bulk(**kwargs: Any) -> None:
+    headers = kwargs.get("headers")
+    fields = client.get("/housing/fields/").json()
+    house_schemes = [
+        {
+            "name": f"bulk_{number}",
+            "address": "address",
+            "description": "description",
+            "type_id": fields["housing_types"][0]["id"],
+            "category_id": fields["housing_categories"][0]["id"],
+            "per_night": 100 + number,
+            "characteristics": [
+                {"characteristic_id": characteristic_type["id"], "amount": number}
+                for characteristic_type in fields["characteristic_types"]
+            ],
+        }
+        for number in range(3)
+    ]
+
+    with count_queries() as statements:
+        response = client.post("/housing/bulk", headers=headers, json=house_schemes)
+    assert response.status_code == 200
+    assert len([sql for sql in statements if sql.startswith("INSERT")]) == 3
+
+    for number, housing_id in enumerate(response.json()):
+        document = client.get(f"/housing/{housing_id}").json()
+        assert document["name"] == f"bulk_{number}"
+        assert document["pricing"]["per_night"] == 100 + number
+        assert len(document["characteristics"]) == len(fields["characteristic_types"])
+        assert {
+            characteristic["amount"] for characteristic in document["characteristics"]
+        } == {number}
+
+    house_schemes[-1]["category_id"] = 0
+    response = client.post("/housing/bulk", headers=headers, json=house_schemes)
+    assert response.status_code == 400
+    response = client.post("/housing/bulk", headers=headers, json=[])
+    assert response.status_code == 400
+
+
 def housing(func: Callable) -> Callable:
     @auth
     def wrapper(**kwargs: Dict[str, Union[str, Response, Dict, int]]) -> None:
         headers = kwargs.get("headers")
-        fields = client.get("/housing/fields/", headers=headers).json()
-
-        request_data = {
-            "name": f"test_{random.randint(10, 1000)}",
-            "address": f"test_{random.randint(10, 1000)}",
-            "description": f"test_{random.randint(10, 1000)}",
-            "type_id": random.choice(fields["housing_types"])["id"],
-            "category_id": random.choice(fields["housing_categories"])["id"],
-            "per_night": random.randint(10, 10000),
-            "characteristics": [],
-        }
-        for characteristic_type in fields["characteristic_types"]:
-            request_data["characteristics"].append(
-                {
-                    "characteristic_id": characteristic_type["id"],
-                    "amount": random.randint(0, 30),
-                }
-            )
-
-        response = client.post("/housing", headers=headers, json=request_data)
-        housing_id = response.json()
-        assert isinstance(response.json(), int)
+        housing_id = create_housing(headers)
 
         func(housing_id, **kwargs)
 
@@ -157,6 +289,558 @@ def test_edit_housing(
     assert response.json()["name"] == name
 
 
+@housing
+def test_edit_characteristics(housing_id: int, **kwargs: Any) -> None:
+    headers = kwargs.get("headers")
+    other_housing_id = create_housing(headers)
+    other_document = client.get(f"/housing/{other_housing_id}").json()
+    characteristic_types = client.get("/housing/fields/").json()["characteristic_types"]
+
+    statement_counts = []
+    for amount, types in ((40, characteristic_types[:1]), (50, characteristic_types)):
+        with count_queries() as statements:
+            response = client.put(
+                f"/housing/{housing_id}",
+                headers=headers,
+                json={
+                    "characteristics": [
+                        {"characteristic_id": type_["id"], "amount": amount}
+                        for type_ in types
+                    ]
+                },
+            )
+        assert response.status_code == 200
+        statement_counts.append(len(statements))
+    assert statement_counts[0] == statement_counts[1]
+
+    document = client.get(f"/housing/{housing_id}").json()
+    assert {ch["amount"] for ch in document["characteristics"]} == {50}
+    assert client.get(f"/housing/{other_housing_id}").json() == other_document
+
+    client.delete(f"/housing/{other_housing_id}", headers=headers)
+
+
+@housing
+def test_change_housings_pricing(housing_id: int, **kwargs: Any) -> None:
+    headers = kwargs.get("headers")
+    other_housing_id = create_housing(headers)
+    per_night = client.get(f"/housing/{other_housing_id}").json()["pricing"][
+        "per_night"
+    ]
+
+    with count_queries() as statements:
+        response = client.put(
+            "/housing/pricing/",
+            headers=headers,
+            json={
+                "prices": [{"housing_id": housing_id, "per_night": 200}],
+                "adjustments": [
+                    {
+                        "housing_ids": [housing_id, other_housing_id],
+                        "per_night": 10,
+                        "cleaning": 50,
+                    }
+                ],
+            },
+        )
+    assert response.status_code == 200
+    assert len([sql for sql in statements if sql.startswith("UPDATE")]) == 1
+    prices = {row["housing_id"]: row for row in response.json()}
+    assert prices[housing_id]["per_night"] == 220
+    assert prices[other_housing_id]["per_night"] == round(per_night * 1.1)
+    assert prices[other_housing_id]["cleaning"] == 0
+    document = client.get(f"/housing/{housing_id}").json()
+    assert document["pricing"] == prices[housing_id]
+
+    for pricing_change, status_code in (
+        ({"prices": [{"housing_id": 0, "per_night": 1}]}, 403),
+        ({"prices": [{"housing_id": housing_id, "discount_per_week": 101}]}, 400),
+        ({}, 400),
+    ):
+        response = client.put("/housing/pricing/", headers=headers, json=pricing_change)
+        assert response.status_code == status_code
+    assert client.get(f"/housing/{housing_id}").json() == document
+
+    client.delete(f"/housing/{other_housing_id}", headers=headers)
+
+
+@housing
+def test_housing_quote(housing_id: int, **kwargs: Any) -> None:
+    headers = kwargs.get("headers")
+    client.put(
+        "/housing/pricing/",
+        headers=headers,
+        json={
+            "prices": [
+                {
+                    "housing_id": housing_id,
+                    "per_night": 100,
+                    "cleaning": 30,
+                    "service": 20,
+                    "discount_per_week": 10,
+                    "discount_per_month": 25,
+                }
+            ]
+        },
+    )
+
+    for nights, discount in ((3, 0), (7, 70), (30, 750)):
+        response = client.get(
+            "/housing/quote/",
+            params={
+                "check_in": "2030-01-01",
+                "check_out": str(date(2030, 1, 1) + timedelta(days=nights)),
+                "housing_ids": [housing_id, 0],
+            },
+        )
+        assert response.status_code == 200
+        assert response.json() == [
+            {
+                "housing_id": housing_id,
+                "nights": nights,
+                "subtotal": 100 * nights,
+                "discount": discount,
+                "cleaning": 30,
+                "service": 20,
+                "total": 100 * nights - discount + 50,
+            }
+        ]
+
+    response = client.get(
+        "/housing/quote/", params={"check_in": "2030-01-02", "check_out": "2030-01-01"}
+    )
+    assert response.status_code == 400
+
+
+@housing
+def test_housing_nights(housing_id: int, **kwargs: Any) -> None:
+    headers = kwargs.get("headers")
+    per_night = client.get(f"/housing/{housing_id}").json()["pricing"]["per_night"]
+    day = date.today() + timedelta(days=10)
+
+    def span(start: int, end: int, **values: Any) -> dict:
+        return {
+            "start": str(day + timedelta(days=start)),
+            "end": str(day + timedelta(days=end)),
+            **values,
+        }
+
+    response = client.patch(
+        f"/housing/{housing_id}/nights",
+        headers=headers,
+        json={
+            "spans": [
+                span(1, 3, price=per_night + 100),
+                span(2, 3, available=False),
+                span(400, 401, price=1),
+            ]
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()["start"] == str(day + timedelta(days=1))
+    assert response.json()["prices"][:3] == [per_night + 100] * 2 + [per_night]
+
+    window = {"start": str(day), "end": str(day + timedelta(days=4))}
+    with count_queries() as statements:
+        response = client.get(f"/housing/{housing_id}/nights", params=window)
+    assert len(statements) == 1
+    assert response.json()["prices"] == [
+        per_night,
+        per_night + 100,
+        per_night + 100,
+        per_night,
+    ]
+    assert response.json()["available"] == [True, True, False, True]
+
+    # nights the host priced replace per_night, the others keep it
+    for nights, subtotal in ((4, 4 * per_night + 200), (500, 499 * per_night + 201)):
+        response = client.get(
+            "/housing/quote/",
+            params={
+                "check_in": str(day),
+                "check_out": str(day + timedelta(days=nights)),
+                "housing_ids": [housing_id],
+            },
+        )
+        assert response.json()[0]["subtotal"] == subtotal
+
+    client.patch(
+        f"/housing/{housing_id}/nights",
+        headers=headers,
+        json={"spans": [span(0, 4, reset_price=True, available=True)]},
+    )
+    response = client.get(f"/housing/{housing_id}/nights", params=window)
+    assert response.json()["prices"] == [per_night] * 4
+    assert all(response.json()["available"])
+    response = client.get(f"/housing/{housing_id}/nights", params={"start": str(day)})
+    assert len(response.json()["prices"]) == 365
+
+    for spans in ([span(-20, -5, price=1)], [span(3, 1, price=1)], []):
+        response = client.patch(
+            f"/housing/{housing_id}/nights", headers=headers, json={"spans": spans}
+        )
+        assert response.status_code == 400
+
+
+@housing
+def test_requests(housing_id: int, **kwargs: Any) -> None:
+    headers = kwargs.get("headers")
+    stay: Dict[str, Any] = {"check_in": "2030-02-01", "check_out": "2030-02-05"}
+
+    request_ids = []
+    for check_in, check_out in (
+        ("2030-02-01", "2030-02-05"),
+        ("2030-02-04", "2030-02-06"),
+        ("2030-02-05", "2030-02-07"),
+    ):
+        response = client.post(
+            "/requests",
+            headers=headers,
+            json={
+                "housing_id": housing_id,
+                "check_in": check_in,
+                "check_out": check_out,
+                "number_of_guests": 2,
+            },
+        )
+        assert response.status_code == 200
+        assert response.json()["accepted"] is False
+        request_ids.append(response.json()["id"])
+
+    response = client.put(f"/requests/{request_ids[0]}/accept", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["accepted"] is True
+    assert response.json()["during"]["bounds"] == "[)"
+    # overlaps the first one, the third one starts on its check out day
+    response = client.put(f"/requests/{request_ids[1]}/accept", headers=headers)
+    assert response.status_code == 409
+    response = client.put(f"/requests/{request_ids[2]}/accept", headers=headers)
+    assert response.status_code == 200
+
+    response = client.get("/requests", headers=headers)
+    accepted = {request["id"]: request["accepted"] for request in response.json()}
+    assert accepted == dict(zip(request_ids, (True, False, True)))
+
+    response = client.put("/requests/0/accept", headers=headers)
+    assert response.status_code == 403
+    response = client.post(
+        "/requests",
+        headers=headers,
+        json={"housing_id": housing_id, **stay, "number_of_guests": 20},
+    )
+    assert response.status_code == 400
+
+
+@housing
+def test_requests_concurrent_accept(housing_id: int, **kwargs: Any) -> None:
+    db = Session()
+    housing_obj: Housing = db.query(Housing).filter(Housing.id == housing_id).one()
+    user = User(id=housing_obj.user_id)
+    # overlapping stays, each one shifted by a day
+    housing_requests = [
+        HousingRequest(
+            housing_id=housing_id,
+            user_id=user.id,
+            during=DateTimeRange(
+                datetime(2030, 3, 1) + timedelta(days=number % 3),
+                datetime(2030, 3, 4) + timedelta(days=number % 3),
+                "[)",
+            ),
+            number_of_guests=1,
+        )
+        for number in range(200)
+    ]
+    db.add_all(housing_requests)
+    db.commit()
+    request_ids = [housing_request.id for housing_request in housing_requests]
+    db.close()
+
+    def accept(request_id: int) -> int:
+        db = Session()
+        try:
+            accept_request_(request_id, user, db)
+            return 200
+        except HTTPException as error:
+            status_code: int = error.status_code
+            return status_code
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        status_codes = Counter(executor.map(accept, request_ids))
+
+    assert status_codes == {200: 1, 409: 199}
+    db = Session()
+    assert (
+        db.query(HousingRequest)
+        .filter(HousingRequest.housing_id == housing_id, HousingRequest.accepted)
+        .count()
+        == 1
+    )
+    db.close()
+
+
+def test_hash_upload() -> None:
+    content = os.urandom(200 * 1024 + 1)
+    source = io.BytesIO(content)
+
+    saved = hash_upload(source, len(content))
+    assert saved == (len(content), hashlib.sha256(content).hexdigest())
+    assert source.read() == content
+
+    try:
+        hash_upload(io.BytesIO(content), len(content) - 1)
+    except HTTPException as error:
+        assert error.status_code == 413
+    else:
+        assert False
+
+
+def check_storage(storage: MediaStorage) -> None:
+    small, large = os.urandom(1000), os.urandom(300 * 1024)
+    for key, content in (("housings/a/small.jpg", small), ("users/large.jpg", large)):
+        assert storage.stat(key) is None and storage.get(key) is None
+        storage.put(key, io.BytesIO(content))
+        # keys name immutable content
+        storage.put(key, io.BytesIO(b"other"))
+        assert storage.get(key) == content
+        assert storage.stat(key).size == len(content)  # type: ignore
+        assert b"".join(storage.stream(key)) == content
+        assert b"".join(storage.stream(key, 10, 100_000)) == content[10:100_000]
+
+    # packed one after the other, and read once both are
+    first, second = os.urandom(400), os.urandom(400)
+    storage.put("housings/a/first.jpg", io.BytesIO(first))
+    storage.put("housings/a/second.jpg", io.BytesIO(second))
+    assert b"".join(storage.stream("housings/a/first.jpg", 0, 5000)) == first
+    assert b"".join(storage.stream("housings/a/first.jpg", 400, 5000)) == b""
+
+    assert storage.copy("users/large.jpg", "users/copy.jpg")
+    assert not storage.copy("users/missing.jpg", "users/other.jpg")
+    assert storage.get("users/copy.jpg") == large
+    for key in (
+        "housings/a/small.jpg",
+        "housings/a/first.jpg",
+        "housings/a/second.jpg",
+        "users/large.jpg",
+        "users/copy.jpg",
+    ):
+        storage.delete(key)
+        assert storage.stat(key) is None
+
+
+def test_media_backends() -> None:
+    check_storage(MemoryStorage())
+    with tempfile.TemporaryDirectory() as folder:
+        check_storage(LocalStorage(folder))
+        assert sorted(os.listdir(folder)) == ["housings", "users"]
+
+    with tempfile.TemporaryDirectory() as folder:
+        large = MemoryStorage()
+        pack = PackStorage(folder, large, max_packed_bytes=1024, segment_bytes=2048)
+        check_storage(pack)
+        # another process, which reads the index the first one wrote
+        other = PackStorage(folder, large, max_packed_bytes=1024, segment_bytes=2048)
+        contents = [os.urandom(700) for _ in range(4)]
+        for number, content in enumerate(contents):
+            (pack, other)[number % 2].put(f"housings/{number}", io.BytesIO(content))
+        for number, content in enumerate(contents):
+            assert (other, pack)[number % 2].get(f"housings/{number}") == content
+            assert large.stat(f"housings/{number}") is None
+        # 700 bytes fit twice in a segment
+        assert len([name for name in os.listdir(folder) if name.endswith(".pack")]) == 3
+        other.delete("housings/0")
+        assert pack.stat("housings/0") is None
+
+
+@housing
+def test_image_derivatives(housing_id: int, **kwargs: Any) -> None:
+    storage: MediaStorage = kwargs["storage"]
+    headers = kwargs.get("headers")
+    image = upload_housing_image(housing_id, headers, random_jpeg()).json()
+    key = f"housings/{image['file_name']}"
+    variants = [derived_key(key, variant) for variant in IMAGE_VARIANTS]
+    # the derivatives made after the upload are dropped, so the request below
+    # has to make them
+    image_derivatives.submit(key).result()
+    for variant in variants:
+        storage.delete(variant)
+
+    response = client.get(image["urls"]["card"]["webp"])
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    with Image.open(io.BytesIO(response.content)) as card:
+        assert max(card.size) <= IMAGE_SIZES["card"]
+    assert all(storage.stat(variant) for variant in variants)
+    document = client.get(f"/housing/{housing_id}").json()
+    assert document["housing_images"][0]["urls"] == image["urls"]
+
+    for url in (
+        image["urls"]["card"]["webp"].replace("card", "huge"),
+        image["urls"]["card"]["webp"].replace("housings", "chats"),
+        "/media/housings/derived/missing.jpg/card.webp",
+    ):
+        assert client.get(url).status_code == 404
+
+    response = upload_housing_image(housing_id, headers, b"not an image")
+    assert response.status_code == 415
+    # stored before uploads were checked
+    storage.put("housings/broken.jpg", io.BytesIO(b"not an image"))
+    response = client.get("/media/housings/derived/broken.jpg/card.webp")
+    assert response.status_code == 404
+    storage.delete("housings/broken.jpg")
+
+    client.delete(
+        "/housing/image/",
+        headers=headers,
+        data={"housing_id": housing_id, "image_id": image["id"]},
+    )
+    assert not any(storage.stat(variant) for variant in variants)
+
+
+@housing
+def test_image_storage(housing_id: int, **kwargs: Any) -> None:
+    storage: MediaStorage = kwargs["storage"]
+    headers = kwargs.get("headers")
+    content = random_jpeg()
+    file_name = content_file_name(hashlib.sha256(content).hexdigest(), "jpg")
+    key = f"housings/{file_name}"
+
+    images = [
+        upload_housing_image(housing_id, headers, content).json() for _ in range(2)
+    ]
+    assert [image["file_name"] for image in images] == [file_name] * 2
+    response = client.get(f"/media/{key}")
+    assert response.content == content
+    assert response.headers["content-type"] == "image/jpeg"
+    for url in ("/media/housings/missing.jpg", "/media/chats/missing.jpg"):
+        assert client.get(url).status_code == 404
+
+    db = Session()
+    media_file = db.query(MediaFile).filter(MediaFile.path == key)
+    assert media_file.one().reference_count == 2
+    # a rolled back delete keeps its file
+    db.query(HousingImage).filter(HousingImage.file_name == file_name).delete()
+    db.rollback()
+    release_files("housings", [file_name], db)
+    assert storage.stat(key) is not None
+
+    for image, exists in zip(images, (True, False)):
+        client.delete(
+            "/housing/image/",
+            headers=headers,
+            data={"housing_id": housing_id, "image_id": image["id"]},
+        )
+        assert (storage.stat(key) is not None) == exists
+    assert media_file.first() is None
+    db.close()
+
+
+class FullStorage(MemoryStorage):
+    def put(self, key: str, source: BinaryIO) -> None:
+        raise OSError("No space left on device")
+
+
+@housing
+def test_image_storage_failure(housing_id: int, **kwargs: dict) -> None:
+    content = random_jpeg()
+    file_name = content_file_name(hashlib.sha256(content).hexdigest(), "jpg")
+
+    with use_media_storage(FullStorage()):
+        try:
+            upload_housing_image(housing_id, kwargs.get("headers"), content)
+        except OSError:
+            pass
+        else:
+            raise AssertionError("the upload didn't fail")
+
+    db = Session()
+    assert db.query(HousingImage).filter_by(file_name=file_name).first() is None
+    assert db.query(MediaFile).filter_by(path=f"housings/{file_name}").first() is None
+    db.close()
+
+
+@housing
+def test_media_serving(housing_id: int, **kwargs: Any) -> None:
+    storage: MediaStorage = kwargs["storage"]
+    content = random_jpeg()
+    image = upload_housing_image(housing_id, kwargs.get("headers"), content).json()
+    url = f"/media/housings/{image['file_name']}"
+
+    response = client.get(url)
+    assert response.content == content
+    assert "immutable" in response.headers["cache-control"]
+    assert response.headers["accept-ranges"] == "bytes"
+    etag = response.headers["etag"]
+    assert client.get(image["urls"]["card"]["webp"]).headers["etag"] != etag
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    size = len(content)
+    for range_header, start, end in (
+        ("bytes=0-99", 0, 100),
+        ("bytes=100-", 100, size),
+        ("bytes=-10", size - 10, size),
+        (f"bytes=10-{size * 2}", 10, size),
+    ):
+        response = client.get(url, headers={"Range": range_header})
+        assert response.status_code == 206
+        assert response.content == content[start:end]
+        assert response.headers["content-range"] == f"bytes {start}-{end - 1}/{size}"
+    for headers in (
+        {"Range": "bytes=0-1,5-6"},
+        {"Range": "bytes=0-1", "If-Range": '"other"'},
+    ):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert response.content == content
+    response = client.get(url, headers={"Range": f"bytes={size}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{size}"
+
+    # files of their own are sent by nginx, others, e.g. packed ones, by the app
+    key = f"housings/{image['file_name']}"
+    stored = storage.stat(key)
+    assert stored is not None
+    served = media_response(key, stored, accel_prefix="/protected-media")
+    assert "x-accel-redirect" not in served.headers
+    with tempfile.TemporaryDirectory() as folder:
+        with use_media_storage(LocalStorage(folder)) as local:
+            local.put(key, io.BytesIO(content))
+            stored = local.stat(key)
+            assert stored is not None
+            served = media_response(key, stored, accel_prefix="/protected-media")
+    assert served.headers["x-accel-redirect"] == f"/protected-media/{key}"
+    assert served.headers["content-type"] == "image/jpeg"
+    assert not served.body
+
+
+@housing
+def test_migrate_files(housing_id: int, **kwargs: Any) -> None:
+    storage: MediaStorage = kwargs["storage"]
+    content = random_jpeg()
+    old_key = f"housings/{uuid.uuid4()}.JPG"
+    storage.put(old_key, io.BytesIO(content))
+    storage.put(derived_key(old_key, "card.webp"), io.BytesIO(b"card"))
+    db = Session()
+    image = HousingImage(housing_id=housing_id, file_name=old_key.split("/")[1])
+    db.add(image)
+    db.commit()
+
+    migrate_files(db)
+    db.refresh(image)
+    file_name = content_file_name(hashlib.sha256(content).hexdigest(), "jpg")
+    assert image.file_name == file_name
+    new_key = f"housings/{file_name}"
+    assert storage.get(new_key) == content
+    assert storage.get(derived_key(new_key, "card.webp")) == b"card"
+
+    collect_files(db)
+    assert storage.stat(old_key) is None
+    assert storage.stat(derived_key(old_key, "card.webp")) is None
+    assert storage.get(new_key) == content
+    db.close()
+
+
 @housing
 def test_housing_image(
     housing_id: int, **kwargs: Dict[str, Union[str, Response, Dict, int]]
@@ -253,3 +937,636 @@ def test_offers() -> None:
 
     assert response.status_code == 200
     assert response.json() is not None
+
+    for limit in (0, -1, OFFERS_LIMIT + 1):
+        for params in ({"limit": limit}, {"limit": limit, "after": ""}):
+            assert client.get("/offers", params=params).status_code == 422
+        response = client.get("/offers/search", params={"limit": limit})
+        assert response.status_code == 422
+
+
+def find_offer(housing_id: int) -> Union[dict, None]:
+    cursor = ""
+    while cursor is not None:
+        page = client.get(
+            "/offers", params={"after": cursor, "limit": OFFERS_LIMIT}
+        ).json()
+        for offer in page["offers"]:
+            if offer["id"] == housing_id:
+                return dict(offer)
+        cursor = page["next_cursor"]
+    return None
+
+
+def upload_housing_image(
+    housing_id: int, headers: Any, content: Union[bytes, None] = None
+) -> Response:
+    if content is not None:
+        return client.post(
+            "/housing/image/",
+            files={"image": ("image.jpg", content)},
+            headers=headers,
+            data={"housing_id": housing_id},
+        )
+    with open("test/test_image.jpg", "rb") as file:
+        return client.post(
+            "/housing/image/",
+            files={"image": file},
+            headers=headers,
+            data={"housing_id": housing_id},
+        )
+
+
+def random_jpeg() -> bytes:
+    # images with the same content share their file
+    image = Image.frombytes("RGB", (64, 48), os.urandom(64 * 48 * 3))
+    content = io.BytesIO()
+    image.save(content, "JPEG")
+    return content.getvalue()
+
+
+@housing
+def test_offers_keyset(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+    upload_housing_image(housing_id, headers)
+
+    for sort in ("newest", "price"):
+        ids = []
+        cursor = ""
+        while cursor is not None:
+            response = client.get(
+                "/offers", params={"after": cursor, "limit": 1, "sort": sort}
+            )
+            assert response.status_code == 200
+            assert len(response.json()["offers"]) <= 1
+            ids += [offer["id"] for offer in response.json()["offers"]]
+            cursor = response.json()["next_cursor"]
+
+        assert housing_id in ids
+        assert len(ids) == len(set(ids))
+
+    response = client.get("/offers", params={"after": "not a cursor"})
+    assert response.status_code == 400
+
+
+@housing
+def test_housing_rating(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+    upload_housing_image(housing_id, headers)
+    other_housing_id = create_housing(headers)
+    upload_housing_image(other_housing_id, headers)
+
+    db = Session()
+    categories = [ReviewCategory(name="Cleanliness"), ReviewCategory(name="Location")]
+    db.add_all(categories)
+    db.flush()
+    cleanliness, location = (category.id for category in categories)
+    grades = [
+        ReviewGrade(housing_id=housing_id, review_category_id=cleanliness, grade=5),
+        ReviewGrade(housing_id=housing_id, review_category_id=cleanliness, grade=4),
+        ReviewGrade(housing_id=housing_id, review_category_id=location, grade=3),
+        ReviewGrade(housing_id=other_housing_id, review_category_id=location, grade=1),
+    ]
+    db.add_all(grades)
+    db.commit()
+
+    def ratings(housing_id: int) -> tuple:
+        document = client.get(f"/housing/{housing_id}").json()
+        return document["rating"], {
+            rating["review_category_id"]: (rating["rating"], rating["grade_count"])
+            for rating in document["review_ratings"]
+        }
+
+    rating, review_ratings = ratings(housing_id)
+    assert (rating["rating"], rating["grade_count"]) == (4, 3)
+    assert "grade_sum" not in rating
+    assert review_ratings == {cleanliness: (4.5, 2), location: (3, 1)}
+
+    grades[1].grade = 2
+    grades[2].review_category_id = cleanliness
+    db.delete(grades[0])
+    db.commit()
+    rating, review_ratings = ratings(housing_id)
+    assert (rating["rating"], rating["grade_count"]) == (2.5, 2)
+    assert review_ratings == {cleanliness: (2.5, 2), location: (0, 0)}
+
+    card = find_offer(housing_id)
+    assert card is not None
+    assert (card["rating"], card["rating_count"]) == (2.5, 2)
+
+    ids, keys = [], []
+    cursor = ""
+    while cursor is not None:
+        response = client.get(
+            "/offers", params={"after": cursor, "limit": 1, "sort": "rating"}
+        )
+        assert response.status_code == 200
+        for offer in response.json()["offers"]:
+            ids.append(offer["id"])
+            keys.append((offer["rating"], offer["id"]))
+        cursor = response.json()["next_cursor"]
+    assert keys == sorted(keys, reverse=True)
+    assert ids.index(housing_id) < ids.index(other_housing_id)
+
+    client.delete(f"/housing/{other_housing_id}", headers=headers)
+    db.query(ReviewGrade).filter(ReviewGrade.housing_id == housing_id).delete()
+    db.query(ReviewCategory).filter(
+        ReviewCategory.id.in_([cleanliness, location])
+    ).delete(synchronize_session=False)
+    db.commit()
+    db.close()
+
+
+@housing
+def test_listing_card(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+
+    def card() -> Union[dict, None]:
+        return find_offer(housing_id)
+
+    assert card() is None
+    image = upload_housing_image(housing_id, headers).json()
+    document = client.get(f"/housing/{housing_id}").json()
+    amounts = {
+        characteristic["characteristic_type"]["name"]: characteristic["amount"]
+        for characteristic in document["characteristics"]
+    }
+    updated_at = card()["updated_at"]  # type: ignore
+    assert updated_at >= document["updated_at"]
+    assert card() == {
+        "id": housing_id,
+        "created_at": document["created_at"],
+        "updated_at": updated_at,
+        "name": document["name"],
+        "address": document["address"],
+        "category_id": document["category_id"],
+        "category_name": next(
+            category["name"]
+            for category in client.get("/housing/fields/").json()["housing_categories"]
+            if category["id"] == document["category_id"]
+        ),
+        "type_id": document["type_id"],
+        "type_name": document["type"]["name"],
+        "main_image": image["file_name"],
+        "main_image_urls": image_urls("housings", image["file_name"]),
+        "per_night": document["pricing"]["per_night"],
+        "guests": amounts.get("guests"),
+        "bedrooms": amounts.get("bedrooms"),
+        "beds": amounts.get("beds"),
+        "baths": amounts.get("baths"),
+        "rating": 0,
+        "rating_count": 0,
+    }
+
+    client.put(f"/housing/{housing_id}", headers=headers, json={"name": "renamed"})
+    client.put(
+        "/housing/pricing/",
+        headers=headers,
+        json={"prices": [{"housing_id": housing_id, "per_night": 123}]},
+    )
+    other_image = upload_housing_image(housing_id, headers).json()
+    client.put(
+        "/housing/image/set_main",
+        headers=headers,
+        data={"housing_id": housing_id, "image_id": other_image["id"]},
+    )
+    assert {"name": "renamed", "per_night": 123}.items() <= card().items()  # type: ignore
+    assert card()["main_image"] == other_image["file_name"]  # type: ignore
+
+    for image_id in (other_image["id"], image["id"]):
+        client.delete(
+            "/housing/image/",
+            headers=headers,
+            data={"housing_id": housing_id, "image_id": image_id},
+        )
+    assert card() is None
+
+
+@housing
+def test_offers_liked(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+    upload_housing_image(housing_id, headers)
+    params = {"after": "", "limit": 1}
+
+    def liked(headers: Any = None) -> dict:
+        offers = client.get("/offers", params=params, headers=headers).json()
+        offer: dict = offers["offers"][0]
+        return offer
+
+    assert "liked" not in liked()
+    assert liked(headers)["liked"] is False
+
+    client.post("/user/wishlist", headers=headers, json={"housing_id": housing_id})
+    assert liked(headers)["liked"] is True
+    with count_queries() as statements:
+        assert liked(headers)["liked"] is True
+    assert not any("liked_housing" in statement for statement in statements)
+
+    response = client.get(
+        "/offers/search",
+        params={"q": client.get(f"/housing/{housing_id}").json()["name"]},
+        headers=headers,
+    )
+    assert {"id": housing_id, "liked": True}.items() <= response.json()["offers"][
+        0
+    ].items()
+
+    client.delete("/user/wishlist", headers=headers, json={"housing_id": housing_id})
+    assert liked(headers)["liked"] is False
+
+
+@housing
+def test_offers_export(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+    upload_housing_image(housing_id, headers)
+
+    response = client.get("/offers/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    offers = [json.loads(line) for line in response.text.splitlines()]
+    offer = next(offer for offer in offers if offer["id"] == housing_id)
+    assert offer == find_offer(housing_id)
+
+    keys = [(offer["updated_at"], offer["id"]) for offer in offers]
+    assert keys == sorted(keys)
+
+    response = client.get(
+        "/offers/export", params={"updated_since": offer["updated_at"]}
+    )
+    assert housing_id in [json.loads(line)["id"] for line in response.text.splitlines()]
+
+    def exported_since(updated_since: datetime) -> List[dict]:
+        response = client.get(
+            "/offers/export", params={"updated_since": updated_since.isoformat()}
+        )
+        return [json.loads(line) for line in response.text.splitlines()]
+
+    # changes to other tables than housing move the updated_at of the card
+    updated_since = datetime.fromisoformat(offer["updated_at"]) + timedelta(
+        microseconds=1
+    )
+    assert housing_id not in [offer["id"] for offer in exported_since(updated_since)]
+    client.put(
+        "/housing/pricing/",
+        headers=headers,
+        json={"prices": [{"housing_id": housing_id, "per_night": 321}]},
+    )
+    offers = exported_since(updated_since)
+    assert [offer["per_night"] for offer in offers if offer["id"] == housing_id] == [
+        321
+    ]
+
+    response = client.get(
+        "/offers/export", params={"updated_since": "2999-01-01T00:00:00"}
+    )
+    assert response.status_code == 200
+    assert response.text == ""
+
+
+@housing
+def test_offers_filters(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+    upload_housing_image(housing_id, headers)
+    housing_data = client.get(f"/housing/{housing_id}").json()
+    per_night = housing_data["pricing"]["per_night"]
+    guests = [
+        characteristic["amount"]
+        for characteristic in housing_data["characteristics"]
+        if characteristic["characteristic_type"]["name"] == "guests"
+    ][0]
+    params = {
+        "after": "",
+        "limit": 1000,
+        "category_id": housing_data["category_id"],
+        "type_id": housing_data["type_id"],
+        "price_min": per_night,
+        "price_max": per_night,
+        "guests": guests,
+        "facets": True,
+    }
+
+    response = client.get("/offers", params=params)
+    assert response.status_code == 200
+    assert housing_id in [offer["id"] for offer in response.json()["offers"]]
+    facets = response.json()["facets"]
+    assert [
+        category["count"]
+        for category in facets["categories"]
+        if category["id"] == housing_data["category_id"]
+    ][0] >= 1
+
+    for excluding in ({"price_min": per_night + 1}, {"guests": guests + 1}):
+        response = client.get("/offers", params={**params, **excluding})
+        assert response.status_code == 200
+        assert housing_id not in [offer["id"] for offer in response.json()["offers"]]
+
+
+@housing
+def test_offers_search(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+    upload_housing_image(housing_id, headers)
+    word = f"seaview{random.randint(10000, 100000)}"
+    client.put(
+        f"/housing/{housing_id}",
+        headers=headers,
+        json={"description": f"Cozy apartments with a {word}"},
+    )
+
+    response = client.get("/offers/search", params={"q": f"{word} apartment"})
+    assert response.status_code == 200
+    assert [offer["id"] for offer in response.json()["offers"]] == [housing_id]
+    assert "search_vector" not in response.json()["offers"][0]
+
+    response = client.get("/offers/search", params={"q": f"{word} -apartment"})
+    assert response.status_code == 200
+    assert response.json()["offers"] == []
+
+
+@housing
+def test_offers_search_ties(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+    housing_ids = [housing_id, create_housing(headers), create_housing(headers)]
+    word = f"lakeview{random.randint(10000, 100000)}"
+    for tied_id in housing_ids:
+        upload_housing_image(tied_id, headers)
+        client.put(
+            f"/housing/{tied_id}",
+            headers=headers,
+            json={"description": f"Quiet rooms with a {word}"},
+        )
+
+    ids = []
+    cursor = ""
+    while cursor is not None:
+        response = client.get(
+            "/offers/search", params={"q": word, "after": cursor, "limit": 1}
+        )
+        assert response.status_code == 200
+        ids += [offer["id"] for offer in response.json()["offers"]]
+        cursor = response.json()["next_cursor"]
+    assert ids == sorted(housing_ids, reverse=True)
+
+    for tied_id in housing_ids[1:]:
+        client.delete(f"/housing/{tied_id}", headers=headers)
+
+
+@housing
+def test_offers_availability(housing_id: int, **kwargs: Any) -> None:
+    headers = kwargs.get("headers")
+    user_id = kwargs["response"].json()["id"]
+    upload_housing_image(housing_id, headers)
+    check_in = date.today() + timedelta(days=10)
+    params: Dict[str, Any] = {
+        "after": "",
+        "limit": 1000,
+        "check_in": str(check_in),
+        "check_out": str(check_in + timedelta(days=3)),
+    }
+
+    def offer_ids() -> list:
+        response = client.get("/offers", params=params)
+        assert response.status_code == 200
+        return [offer["id"] for offer in response.json()["offers"]]
+
+    # no calendar
+    assert housing_id not in offer_ids()
+
+    db = Session()
+    db.add(
+        HousingCalendar(
+            housing_id=housing_id,
+            during=DateTimeRange(
+                datetime.combine(date.today(), time()),
+                datetime.combine(date.today() + timedelta(days=60), time()),
+            ),
+            min_nights=1,
+            max_nights=30,
+            notification_diff_days=1,
+            notification_max_time=time(12),
+        )
+    )
+    db.commit()
+    assert housing_id in offer_ids()
+
+    # nights the host blocked, the stay is the 3 nights from check_in
+    for start, available in ((3, False), (1, False), (1, True)):
+        client.patch(
+            f"/housing/{housing_id}/nights",
+            headers=headers,
+            json={
+                "spans": [
+                    {
+                        "start": str(check_in + timedelta(days=start)),
+                        "end": str(check_in + timedelta(days=start + 1)),
+                        "available": available,
+                    }
+                ]
+            },
+        )
+        assert (housing_id in offer_ids()) == (start == 3 or available)
+
+    request = HousingRequest(
+        housing_id=housing_id,
+        user_id=user_id,
+        number_of_guests=1,
+        accepted=True,
+        during=DateTimeRange(
+            datetime.combine(check_in + timedelta(days=2), time()),
+            datetime.combine(check_in + timedelta(days=5), time()),
+        ),
+    )
+    db.add(request)
+    db.commit()
+    assert housing_id not in offer_ids()
+
+    db.delete(request)
+    db.commit()
+    db.close()
+
+    response = client.get("/offers", params={**params, "check_out": str(check_in)})
+    assert response.status_code == 400
+
+
+def test_serializers() -> None:
+    offer = make_offer(1)
+    shapes: List[Dict[str, Any]] = [
+        {},
+        {"extra_fields": ["characteristics", "category", "pricing", "type"]},
+        {"extend": ["created_at", "updated_at"], "extra_fields": ["housing_images"]},
+        {"fields": ["id", "name", "pricing"]},
+    ]
+    for kwargs in shapes:
+        assert serialize(offer, **kwargs) == legacy_as_dict(offer, **kwargs)
+        assert offer.as_dict(**kwargs) == legacy_as_dict(offer, **kwargs)
+
+    user = User(id=1, password="hash")
+    assert "password" not in user.as_dict()
+    assert "password" not in user.as_dict(fields=["id", "password"])
+
+
+def test_orjson_response() -> None:
+    content = {
+        "price": Decimal("10.50"),
+        "phone": PhoneNumber("+79161234567"),
+        "during": DateTimeRange(datetime(2022, 1, 1), datetime(2022, 1, 8)),
+        1: date(2022, 1, 1),
+    }
+    assert json.loads(ORJSONResponse(content).body) == {
+        "price": 10.5,
+        "phone": "+79161234567",
+        "during": {
+            "lower": "2022-01-01 00:00:00",
+            "upper": "2022-01-08 00:00:00",
+            "bounds": "[)",
+        },
+        "1": "2022-01-01",
+    }
+
+    offers = make_offer(1).as_dict(extra_fields=["characteristics", "pricing"])
+    assert ORJSONResponse(offers).body == JSONResponse(jsonable_encoder(offers)).body
+
+
+@contextmanager
+def count_queries() -> Iterator[List[str]]:
+    statements: List[str] = []
+
+    def before_cursor_execute(*args: Any) -> None:
+        statements.append(args[2])
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@housing
+def test_offers_query_count(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+    other_housing_id = create_housing(headers)
+    upload_housing_image(housing_id, headers)
+    upload_housing_image(other_housing_id, headers)
+
+    counts = []
+    for limit in (1, 2):
+        for params in ({"limit": limit}, {"limit": limit, "after": ""}):
+            with count_queries() as statements:
+                response = client.get("/offers", params=params)
+            assert response.status_code == 200
+            assert len(response.json()) >= 1
+            counts.append(len(statements))
+    assert counts[:2] == counts[2:]
+
+    with count_queries() as statements:
+        client.get(f"/housing/{housing_id}")
+    detail_count = len(statements)
+    upload_housing_image(housing_id, headers)
+    with count_queries() as statements:
+        client.get(f"/housing/{housing_id}")
+    assert len(statements) == detail_count
+
+    client.delete(f"/housing/{other_housing_id}", headers=headers)
+
+
+@housing
+def test_housing_document(housing_id: int, **kwargs: dict) -> None:
+    headers = kwargs.get("headers")
+    upload_housing_image(housing_id, headers)
+    upload_housing_image(housing_id, headers)
+
+    db = Session()
+    housing_obj: Housing = db.query(Housing).filter(Housing.id == housing_id).one()
+    expected = housing_obj.as_dict(
+        extra_fields=[
+            "user",
+            "housing_images",
+            "type",
+            "calendar",
+            "pricing",
+            "rating",
+            "review_ratings",
+        ]
+    )
+    expected["housing_images"] = [
+        image.as_dict(extra_fields=["urls"])
+        for image in sorted(housing_obj.housing_images, key=attrgetter("id"))
+    ]
+    expected["characteristics"] = [
+        characteristic.as_dict(extra_fields=["characteristic_type"])
+        for characteristic in sorted(housing_obj.characteristics, key=attrgetter("id"))
+    ]
+    expected["rules"] = []
+    expected["comforts"] = []
+    db.close()
+
+    response = client.get(f"/housing/{housing_id}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == jsonable_encoder(expected)
+
+    response = client.get("/housing/0")
+    assert response.json() == {"detail": "Housing doesn't exists"}
+
+
+@housing
+def test_housing_document_cache(housing_id: int, **kwargs: Any) -> None:
+    headers = kwargs.get("headers")
+    user_id = kwargs["response"].json()["id"]
+    assert client.get("/housing/cache/").status_code == 401
+    stats = client.get("/housing/cache/", headers=headers).json()
+
+    response = client.get(f"/housing/{housing_id}")
+    etag = response.headers["etag"]
+    with count_queries() as statements:
+        assert client.get(f"/housing/{housing_id}").content == response.content
+        response = client.get(f"/housing/{housing_id}", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+    # only the version is read
+    assert len(statements) == 2
+    assert all("housing_version" in statement for statement in statements)
+
+    client.put(f"/housing/{housing_id}", headers=headers, json={"name": "renamed"})
+    response = client.get(f"/housing/{housing_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["name"] == "renamed"
+
+    image = upload_housing_image(housing_id, headers).json()
+    response = client.get(f"/housing/{housing_id}")
+    assert len(response.json()["housing_images"]) == 1
+
+    new_stats = client.get("/housing/cache/", headers=headers).json()
+    assert new_stats["hits"] - stats["hits"] == 2
+    assert new_stats["misses"] - stats["misses"] == 3
+
+    # changes which leave every updated_at of the document as it was
+    etag = response.headers["etag"]
+    client.delete(
+        "/housing/image/",
+        headers=headers,
+        data={"housing_id": housing_id, "image_id": image["id"]},
+    )
+    response = client.get(f"/housing/{housing_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["housing_images"] == []
+
+    etag = response.headers["etag"]
+    db = Session()
+    db.query(User).filter(User.id == user_id).update(
+        {"name": "owner"}, synchronize_session=False
+    )
+    db.commit()
+    db.close()
+    response = client.get(f"/housing/{housing_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["user"]["name"] == "owner"
+
+    cache = DocumentCache(max_bytes=10)
+    for key in range(3):
+        cache.get(key, 1, lambda: (1, b"12345"))
+    assert cache.get(1, 1, lambda: None) is not None
+    assert cache.get(0, 1, lambda: None) is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 10
+    document = cache.get(1, 2, lambda: (2, b"67890"))
+    assert document is not None and document.version == 2
+    assert cache.get(1, 2, lambda: None) == document
@@ -1,12 +1,36 @@
-from typing import Any, Union
-
-from fastapi import APIRouter, Depends, UploadFile, Form, File, HTTPException
+import hashlib
+import mimetypes
+from datetime import date, datetime, timedelta
+from email.utils import formatdate
+from functools import partial
+from typing import Any, List, Union, Optional
+from urllib.parse import quote
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    UploadFile,
+    Form,
+    File,
+    Header,
+    Query,
+    HTTPException,
+)
 from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from starlette import status
-
-from app.settings import get_db
-from auth.token import get_current_user
+from starlette.responses import Response, StreamingResponse
+
+from app.responses import (
+    ORJSONRoute,
+    NDJSON_MEDIA_TYPE,
+    etag_response,
+    file_response,
+    ndjson_chunks,
+)
+from app.settings import MEDIA_ACCEL_PREFIX, MEDIA_URL, get_db
+from auth.token import get_current_user, get_optional_user
+from core.backends import StoredFile
 from core.models import (
     User,
     Chat,
@@ -16,31 +40,121 @@ from core.schemas import (
     HouseCreate,
     ChatDelete,
     HouseChange,
+    HousingPricingChange,
+    NightsChange,
+    RequestCreate,
+    OfferFilters,
+    SearchFilters,
 )
+from core import storage
 from core.services import (
     create_chat_,
     create_housing,
+    create_housings_bulk_,
+    change_housings_pricing_,
+    get_quotes_,
+    get_nights_,
+    change_nights_,
+    create_request_,
+    get_requests_,
+    accept_request_,
     get_housing_by_user,
     get_chat_short_,
     create_housing_image_,
     delete_housing_image_,
     set_main_housing_image_,
     get_pagination_data,
-    get_housing_,
+    get_keyset_pagination_data,
+    OFFERS_LIMIT,
+    get_image_derivative_,
+    get_media_file_,
+    mark_liked,
+    export_offers_,
+    get_housing_json_,
     create_housings_attrs_,
-    get_housing_fields_,
+    housing_fields_cache,
+    housing_cache,
     create_characteristics,
     delete_housing_,
     change_data_housing,
     create_housing_pricing,
 )
 
-router = APIRouter(prefix="", tags=["core"])
+router = APIRouter(prefix="", tags=["core"], route_class=ORJSONRoute)
 
 
 @router.get("/offers")
-def offers(db: Session = Depends(get_db), page: int = 0, limit: int = 50) -> Any:
-    return get_pagination_data(db, page, limit)
+def offers(
+    db: Session = Depends(get_db),
+    page: int = 0,
+    limit: int = Query(50, ge=1, le=OFFERS_LIMIT),
+    after: Optional[str] = None,
+    sort: str = "newest",
+    facets: bool = False,
+    filters: OfferFilters = Depends(),
+    user: Optional[User] = Depends(get_optional_user),
+) -> Any:
+    # passing `after` (empty for the first page) switches to keyset pagination
+    if after is not None:
+        data = get_keyset_pagination_data(db, after, limit, sort, filters, facets)
+        mark_liked(data["offers"], user, db)
+        return data
+    offers = get_pagination_data(db, page, limit, filters)
+    mark_liked(offers, user, db)
+    return offers
+
+
+@router.get("/offers/search")
+def search_offers(
+    db: Session = Depends(get_db),
+    after: str = "",
+    limit: int = Query(50, ge=1, le=OFFERS_LIMIT),
+    sort: str = "relevance",
+    facets: bool = False,
+    filters: SearchFilters = Depends(),
+    user: Optional[User] = Depends(get_optional_user),
+) -> dict:
+    data = get_keyset_pagination_data(db, after, limit, sort, filters, facets)
+    mark_liked(data["offers"], user, db)
+    return data
+
+
+@router.get("/offers/export")
+def export_offers(
+    db: Session = Depends(get_db),
+    updated_since: Optional[datetime] = None,
+    filters: OfferFilters = Depends(),
+) -> StreamingResponse:
+    # one offer per line, streamed in constant memory
+    offers = export_offers_(db, updated_since, filters)
+    return StreamingResponse(ndjson_chunks(offers), media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.post("/requests")
+def create_request(
+    request_scheme: RequestCreate,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> dict:
+    return create_request_(request_scheme, user, db)
+
+
+@router.get("/requests")
+def get_requests(
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> List[dict]:
+    return get_requests_(user, db)
+
+
+@router.put("/requests/{request_id}/accept")
+def accept_request(
+    request_id: int,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> dict:
+    # 409 when an accepted request overlaps it
+    return accept_request_(request_id, user, db)
 
 
 def check_permissions_on_housing(user: User, housing_id: int, db: Session) -> None:
@@ -106,6 +220,78 @@ async def get_chat_short(
     )
 
 
+# media keys name immutable content
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def media_response(
+    key: str,
+    stored: StoredFile,
+    if_none_match: Union[str, None] = None,
+    range_header: Union[str, None] = None,
+    if_range: Union[str, None] = None,
+    accel_prefix: str = MEDIA_ACCEL_PREFIX,
+) -> Response:
+    media_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+    if accel_prefix and storage.media_storage.is_file(key):
+        # nginx sends the file, with the ETag, ranges and cache headers of the
+        # location of accel_prefix
+        return Response(
+            media_type=media_type,
+            headers={"X-Accel-Redirect": f"{accel_prefix}/{quote(key)}"},
+        )
+    version = f"{key}:{stored.size}:{stored.modified}".encode()
+    headers = {
+        "ETag": f'"{hashlib.sha256(version).hexdigest()[:32]}"',
+        "Cache-Control": MEDIA_CACHE_CONTROL,
+        "Last-Modified": formatdate(stored.modified, usegmt=True),
+    }
+    return file_response(
+        partial(storage.media_storage.stream, key),
+        stored.size,
+        media_type,
+        headers,
+        if_none_match,
+        range_header,
+        if_range,
+    )
+
+
+@router.get(MEDIA_URL + "/{kind}/derived/{file_name:path}/{variant}")
+async def get_image_derivative(
+    kind: str,
+    file_name: str,
+    variant: str,
+    if_none_match: Optional[str] = Header(None),
+    range_header: Optional[str] = Header(None, alias="range"),
+    if_range: Optional[str] = Header(None),
+) -> Response:
+    # derivatives are made in the background after uploads; this also makes
+    # the ones which aren't there yet or were never made
+    derivative = await get_image_derivative_(kind, file_name, variant)
+    if derivative is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Image not found"
+        )
+    return media_response(*derivative, if_none_match, range_header, if_range)
+
+
+@router.get(MEDIA_URL + "/{kind}/{file_name:path}")
+def get_media_file(
+    kind: str,
+    file_name: str,
+    if_none_match: Optional[str] = Header(None),
+    range_header: Optional[str] = Header(None, alias="range"),
+    if_range: Optional[str] = Header(None),
+) -> Response:
+    media_file = get_media_file_(kind, file_name)
+    if media_file is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Image not found"
+        )
+    return media_response(*media_file, if_none_match, range_header, if_range)
+
+
 @router.post("/housing/image/")
 async def create_housing_image(
     housing_id: int = Form(...),
@@ -122,7 +308,7 @@ async def create_housing_image(
     housing_image = await create_housing_image_(
         image, housing_id, db, True if is_main else None
     )
-    return housing_image.as_dict()
+    return housing_image.as_dict(extra_fields=["urls"])
 
 
 @router.delete("/housing/image/")
@@ -136,7 +322,7 @@ async def delete_housing_image(
 
     housing_image = delete_housing_image_(housing_id, image_id, db)
     return (
-        housing_image.as_dict()
+        housing_image.as_dict(extra_fields=["urls"])
         if housing_image
         else {
             "detail": f"This housing with id = {housing_id} doesn't have this image with id = {image_id}"
@@ -155,7 +341,7 @@ async def set_main_housing_image(
 
     housing_image = set_main_housing_image_(housing_id, image_id, db)
     return (
-        housing_image.as_dict()
+        housing_image.as_dict(extra_fields=["urls"])
         if housing_image
         else {
             "detail": f"This housing with id = {housing_id} doesn't have this image with id = {image_id}"
@@ -177,6 +363,63 @@ def create_house(
     return housing.id
 
 
+@router.post("/housing/bulk")
+def create_houses_bulk(
+    house_schemes: List[HouseCreate],
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> List[int]:
+    return create_housings_bulk_(house_schemes, user, db)
+
+
+@router.put("/housing/pricing/")
+def change_houses_pricing(
+    pricing_change: HousingPricingChange,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> List[dict]:
+    return change_housings_pricing_(pricing_change, user, db)
+
+
+@router.get("/housing/quote/")
+def get_quotes(
+    check_in: date,
+    check_out: date,
+    housing_ids: Optional[List[int]] = Query(None),
+    db: Session = Depends(get_db),
+) -> List[dict]:
+    return get_quotes_(db, check_in, check_out, housing_ids)
+
+
+@router.get("/housing/{housing_id}/nights")
+def get_nights(
+    housing_id: int,
+    start: date,
+    end: Optional[date] = None,
+    db: Session = Depends(get_db),
+) -> dict:
+    if end is None:
+        end = start + timedelta(days=365)
+    nights = get_nights_(housing_id, start, end, db)
+    if nights is None:
+        return {"detail": "Housing doesn't exists"}
+    return nights
+
+
+@router.patch("/housing/{housing_id}/nights")
+def change_nights(
+    housing_id: int,
+    nights_change: NightsChange,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> Any:
+    check_permissions_on_housing(user, housing_id, db)
+    nights = change_nights_(housing_id, nights_change, db)
+    if nights is None:
+        return {"detail": "Housing doesn't exists"}
+    return nights
+
+
 @router.delete("/housing/{housing_id}")
 def delete_housing(
     housing_id: int,
@@ -205,9 +448,21 @@ def change_housing(
         return {"detail": "Housing doesn't exist"}
 
 
+@router.get("/housing/cache/")
+def get_housing_cache_stats(user: User = Depends(get_current_user)) -> dict:
+    return housing_cache.stats()
+
+
 @router.get("/housing/{housing_id}")
-def get_housing(housing_id: int, db: Session = Depends(get_db)) -> dict:
-    return get_housing_(housing_id, db)
+def get_housing(
+    housing_id: int,
+    db: Session = Depends(get_db),
+    if_none_match: Optional[str] = Header(None),
+) -> Any:
+    document = get_housing_json_(housing_id, db)
+    if document is None:
+        return {"detail": "Housing doesn't exists"}
+    return etag_response(document.body, document.etag, if_none_match)
 
 
 @router.post("/housing/attrs")
@@ -217,5 +472,9 @@ def create_housings_attrs(db: Session = Depends(get_db)) -> dict:
 
 
 @router.get("/housing/fields/")
-def get_housing_fields(db: Session = Depends(get_db)) -> dict:
-    return get_housing_fields_(db)
+def get_housing_fields(
+    db: Session = Depends(get_db), if_none_match: Optional[str] = Header(None)
+) -> Response:
+    # served from memory once the version of the reference tables is read
+    fields = housing_fields_cache.get(db)
+    return etag_response(fields.body, fields.etag, if_none_match)
@@ -1,14 +1,18 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.exc import SQLAlchemyError
 from starlette.middleware.sessions import SessionMiddleware
-from starlette.staticfiles import StaticFiles
 
+from app.responses import ORJSONResponse
+from app.settings import Session
 from auth.auth import router as auth_router
 from auth.token import SECRET_KEY
+from core.services import housing_fields_cache
+from core.storage import image_derivatives
 from core.views import router as core_router
 from chat.views import router as chat_router
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
 
 
@@ -31,9 +35,23 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+def load_reference_data() -> None:
+    db = Session()
+    try:
+        housing_fields_cache.get(db)
+    except SQLAlchemyError:
+        # e.g. migrations haven't run yet, the cache loads on first use
+        pass
+    finally:
+        db.close()
+
+
+@app.on_event("shutdown")
+def stop_image_workers() -> None:
+    image_derivatives.shutdown()
+
+
 @app.get("/")
 def index() -> dict:
     return {"Hello": "World"}
-
-
-app.mount("/media", StaticFiles(directory="media"), name="media")